@@ -12,7 +12,8 @@ from setuptools import find_packages, setup
 doc_requirements = []
 install_requirements = [
     'boto3>=1.4.4,<2',
-    'sh>=1.12.13,<2']
+    'futures>=3.0.5,<4;python_version<"3.2"',
+    'scandir>=1.5,<2;python_version<"3.5"']
 release_requirements = [
     'zest.releaser[recommended]>=6.6.5,<6.7']
 test_requirements = [
@@ -0,0 +1,383 @@
+# -*- coding: utf-8 -*-
+"""Native readers for terraform state backends.
+
+Booting terraform just to run `terraform state pull` is by far the most
+expensive part of reading a state. A reader fetches the state straight from
+its backend instead: it is registered for a backend type with `reads`, gets
+the backend config terraform recorded in `.terraform/terraform.tfstate`, the
+selected workspace and the directory, and returns the state - decoded, or as
+the path of a state file - or None to have ati fall back to terraform.
+Backends that can enumerate their workspaces register a lister with
+`lists_workspaces` as well.
+
+"""
+from collections import defaultdict
+import gzip
+import io
+import json
+import os
+import socket
+import threading
+
+try:
+    from http.client import HTTPConnection, HTTPException, HTTPSConnection
+    from urllib.parse import quote, urlencode
+except ImportError:  # python 2
+    from httplib import HTTPConnection, HTTPException, HTTPSConnection
+    from urllib import quote, urlencode
+
+from ati.cache import cache_dir, cache_key, read_file, write_file
+from ati.codec import loads
+
+BACKENDS = {}
+WORKSPACE_LISTERS = {}
+
+
+def reads(backend_type):
+    def inner(func):
+        BACKENDS[backend_type] = func
+        return func
+
+    return inner
+
+
+def lists_workspaces(backend_type):
+    def inner(func):
+        WORKSPACE_LISTERS[backend_type] = func
+        return func
+
+    return inner
+
+
+def backend_config(dpath):
+    """Return the backend block terraform recorded for `dpath`, if any."""
+    path = os.path.join(dpath, '.terraform', 'terraform.tfstate')
+    try:
+        with open(path, 'r') as json_file:
+            return json.load(json_file).get('backend')
+    except (IOError, OSError, ValueError):
+        return None
+
+
+def detect_backend(dpath):
+    """Return the backend block of `dpath`, telling local layouts apart.
+
+    Terraform only records a backend block once one is configured, so a
+    `.terraform` dir without one belongs to the local backend.
+
+    """
+    if not os.path.exists(os.path.join(dpath, '.terraform',
+                                       'terraform.tfstate')):
+        return {'type': 'local', 'config': {}}
+    return backend_config(dpath)
+
+
+def current_workspace(dpath):
+    """Return the workspace selected in `dpath`."""
+    if os.environ.get('TF_WORKSPACE'):
+        return os.environ['TF_WORKSPACE']
+    try:
+        with open(os.path.join(dpath, '.terraform', 'environment')) as env:
+            return env.read().strip() or 'default'
+    except (IOError, OSError):
+        return 'default'
+
+
+def list_workspaces(dpath):
+    """Return every workspace of `dpath`, or just the selected one.
+
+    Only backends with a registered lister can tell what workspaces exist.
+
+    """
+    backend = detect_backend(dpath)
+    if not backend or backend.get('type') not in WORKSPACE_LISTERS:
+        return [current_workspace(dpath)]
+
+    lister = WORKSPACE_LISTERS[backend['type']]
+    return lister(backend.get('config') or {}, dpath) or \
+        [current_workspace(dpath)]
+
+
+def read_backend(dpath, workspace=None):
+    """Read the state of `dpath` natively, or return None if we can't.
+
+    Reads the selected workspace unless `workspace` is given.
+
+    """
+    backend = detect_backend(dpath)
+    if not backend or backend.get('type') not in BACKENDS:
+        return None
+
+    reader = BACKENDS[backend['type']]
+    return reader(backend.get('config') or {},
+                  workspace or current_workspace(dpath), dpath)
+
+
+## Local
+def local_path(config, workspace, dpath):
+    """Return the path of the state file of `workspace`."""
+    if workspace == 'default':
+        path = config.get('path') or 'terraform.tfstate'
+    else:
+        path = os.path.join(config.get('workspace_dir') or
+                            'terraform.tfstate.d',
+                            workspace, 'terraform.tfstate')
+    return os.path.join(dpath, path)
+
+
+@lists_workspaces('local')
+def local_workspaces(config, dpath):
+    """List the workspaces with a state file on disk."""
+    workspace_dir = os.path.join(
+        dpath, config.get('workspace_dir') or 'terraform.tfstate.d')
+    try:
+        named = sorted(os.listdir(workspace_dir))
+    except OSError:
+        named = []
+
+    default = ['default'] if os.path.exists(
+        local_path(config, 'default', dpath)) else []
+    return default + [workspace for workspace in named if os.path.exists(
+        local_path(config, workspace, dpath))]
+
+
+@reads('local')
+def local_state(config, workspace, dpath):
+    """Return the path of the state file, it is already on disk.
+
+    A workspace that was never applied has no state file yet, and so no
+    resources either.
+
+    """
+    path = local_path(config, workspace, dpath)
+    if not os.path.exists(path):
+        return {}
+    return path
+
+
+## S3
+# states are downloaded from many threads at once through a shared client
+S3_MAX_POOL_CONNECTIONS = 64
+_S3_CLIENTS = {}
+_S3_CLIENTS_LOCK = threading.Lock()
+
+
+def _s3_client(config):
+    # boto3 is slow to import, so only pay for it when there is an s3 backend
+    import boto3
+    from botocore.config import Config
+
+    options = (config.get('profile'), config.get('region'),
+               config.get('access_key'), config.get('secret_key'),
+               config.get('endpoint'))
+    with _S3_CLIENTS_LOCK:
+        if options not in _S3_CLIENTS:
+            profile, region, access_key, secret_key, endpoint = options
+            session = boto3.session.Session(
+                profile_name=profile or None,
+                region_name=region or None,
+                aws_access_key_id=access_key or None,
+                aws_secret_access_key=secret_key or None)
+            _S3_CLIENTS[options] = session.client(
+                's3', endpoint_url=endpoint or None,
+                config=Config(max_pool_connections=S3_MAX_POOL_CONNECTIONS))
+
+        return _S3_CLIENTS[options]
+
+
+def s3_key(config, workspace):
+    """Return the key the state of `workspace` is stored under."""
+    if workspace == 'default':
+        return config['key']
+
+    return '{}/{}/{}'.format(config.get('workspace_key_prefix') or 'env:',
+                             workspace, config['key'])
+
+
+@lists_workspaces('s3')
+def s3_workspaces(config, dpath):
+    """List the workspaces with a state in the bucket.
+
+    Workspace states live under `<workspace_key_prefix>/<workspace>/<key>`,
+    next to the default workspace state under `<key>`.
+
+    """
+    from botocore.exceptions import BotoCoreError, ClientError
+
+    bucket, key = config['bucket'], config['key']
+    prefix = '{}/'.format(config.get('workspace_key_prefix') or 'env:')
+    suffix = '/' + key
+    client = _s3_client(config)
+    default, named = [], []
+    try:
+        listing = client.list_objects_v2(Bucket=bucket, Prefix=key, MaxKeys=1)
+        if any(obj['Key'] == key for obj in listing.get('Contents', [])):
+            default.append('default')
+
+        paginator = client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+            for obj in page.get('Contents', []):
+                workspace = obj['Key'][len(prefix):-len(suffix)]
+                if obj['Key'].endswith(suffix) and workspace and \
+                   '/' not in workspace:
+                    named.append(workspace)
+    except (BotoCoreError, ClientError):
+        return None
+
+    return default + sorted(named)
+
+
+@reads('s3')
+def s3_state(config, workspace, dpath):
+    """Fetch a state from S3, unless the copy we fetched last time is current.
+
+    Every state fetched is kept in the cache along with its ETag, which is
+    sent as `If-None-Match` next time so an unchanged state costs a single
+    empty response.
+
+    """
+    from botocore.exceptions import BotoCoreError, ClientError
+
+    if config.get('role_arn'):
+        return None  # leave assuming roles to terraform
+
+    bucket, key = config['bucket'], s3_key(config, workspace)
+    cached = os.path.join(cache_dir('s3'), cache_key(bucket, key))
+    etag, body = read_file(cached + '.etag'), read_file(cached + '.tfstate')
+    request = {'Bucket': bucket, 'Key': key}
+    if etag and body is not None:
+        request['IfNoneMatch'] = etag.decode('utf-8')
+
+    try:
+        response = _s3_client(config).get_object(**request)
+    except ClientError as err:
+        if 'IfNoneMatch' not in request or \
+           err.response['Error']['Code'] not in ('304', 'NotModified'):
+            return None
+    except BotoCoreError:
+        return None
+    else:
+        body = response['Body'].read()
+        write_file(cached + '.tfstate', body)
+        write_file(cached + '.etag', response['ETag'].encode('utf-8'))
+
+    return loads(body)
+
+
+## Consul
+class ConnectionPool(object):
+    """Keep-alive HTTP connections, shared by every thread and every state."""
+
+    def __init__(self, timeout=30):
+        self.timeout = timeout
+        self._idle = defaultdict(list)
+        self._lock = threading.Lock()
+
+    def _connect(self, scheme, netloc):
+        with self._lock:
+            if self._idle[scheme, netloc]:
+                return self._idle[scheme, netloc].pop(), True
+
+        connection = HTTPSConnection if scheme == 'https' else HTTPConnection
+        return connection(netloc, timeout=self.timeout), False
+
+    def get(self, scheme, netloc, url, headers=None):
+        """GET `url`, returning the response status, headers and body."""
+        conn, reused = self._connect(scheme, netloc)
+        try:
+            conn.request('GET', url, headers=headers or {})
+            response = conn.getresponse()
+            body = response.read()
+        except (HTTPException, socket.error):
+            conn.close()
+            if not reused:
+                raise
+            # the server dropped the idle connection, try a fresh one
+            return self.get(scheme, netloc, url, headers)
+
+        with self._lock:
+            self._idle[scheme, netloc].append(conn)
+        return response.status, response.msg, body
+
+
+CONSUL_POOL = ConnectionPool()
+
+
+def _consul_get(config, path, **params):
+    address = config.get('address') or '127.0.0.1:8500'
+    scheme = config.get('scheme') or 'http'
+    if '://' in address:
+        scheme, address = address.split('://', 1)
+
+    headers = {}
+    if config.get('access_token'):
+        headers['X-Consul-Token'] = config['access_token']
+    if config.get('datacenter'):
+        params['dc'] = config['datacenter']
+
+    url = '/v1/kv/' + quote(path)
+    if params:
+        url += '?' + urlencode(sorted(params.items()))
+    return CONSUL_POOL.get(scheme, address, url, headers)
+
+
+def consul_path(config, workspace):
+    """Return the key the state of `workspace` is stored under."""
+    if workspace == 'default':
+        return config['path']
+
+    return '{}-env:{}'.format(config['path'], workspace)
+
+
+@lists_workspaces('consul')
+def consul_workspaces(config, dpath):
+    """List the workspaces with a state in consul."""
+    prefix = config['path'] + '-env:'
+    try:
+        status, _, body = _consul_get(config, config['path'], keys='',
+                                      separator='/')
+    except (HTTPException, socket.error):
+        return None
+    if status != 200:
+        return None
+
+    keys = loads(body)
+    return ['default' if key == config['path'] else key[len(prefix):]
+            for key in sorted(keys)
+            if key == config['path'] or key.startswith(prefix)]
+
+
+@reads('consul')
+def consul_state(config, workspace, dpath):
+    """Fetch a state from consul, unless the copy we fetched last time is current.
+
+    Listing the keys under the state's path is a cheap request whose
+    `X-Consul-Index` changes whenever the state does. The index is kept in the
+    cache with the state, which is only downloaded again when it changes.
+
+    """
+    path = consul_path(config, workspace)
+    cached = os.path.join(
+        cache_dir('consul'),
+        cache_key(config.get('address') or '', config.get('datacenter') or '',
+                  path))
+    try:
+        status, headers, _ = _consul_get(config, path, keys='', separator='/')
+        index = (headers.get('X-Consul-Index') or '').encode('utf-8')
+        body = read_file(cached + '.tfstate')
+        if status != 200 or not index or body is None or \
+           read_file(cached + '.index') != index:
+            status, _, body = _consul_get(config, path, raw='')
+            if status != 200:
+                return None
+            write_file(cached + '.tfstate', body)
+            write_file(cached + '.index', index)
+    except (HTTPException, socket.error):
+        return None
+
+    if body[:2] == b'\x1f\x8b':  # `gzip = true` in the backend config
+        body = gzip.GzipFile(fileobj=io.BytesIO(body)).read()
+    state = loads(body)
+    if 'chunks' in state:
+        return None  # leave reassembling chunked states to terraform
+    return state
@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+"""On-disk cache shared by the ati readers."""
+import hashlib
+import os
+import tempfile
+
+
+def cache_dir(*parts):
+    """Return a directory below the ati cache root, creating it if needed.
+
+    The root is `$ATI_CACHE_DIR`, falling back to `$XDG_CACHE_HOME/ati` and
+    then `~/.cache/ati`.
+
+    """
+    root = os.environ.get('ATI_CACHE_DIR')
+    if not root:
+        root = os.path.join(
+            os.environ.get('XDG_CACHE_HOME') or
+            os.path.join(os.path.expanduser('~'), '.cache'),
+            'ati')
+    path = os.path.join(root, *parts)
+    try:
+        os.makedirs(path)
+    except OSError:
+        if not os.path.isdir(path):
+            raise
+    return path
+
+
+def cache_key(*parts):
+    """Hash `parts` into a string that is safe to use as a file name."""
+    return hashlib.sha1(u'\0'.join(parts).encode('utf-8')).hexdigest()
+
+
+def read_file(path):
+    """Return the bytes in `path`, or None when it does not exist."""
+    try:
+        with open(path, 'rb') as fobj:
+            return fobj.read()
+    except (IOError, OSError):
+        return None
+
+
+def write_file(path, data):
+    """Replace `path` with `data` without ever exposing a partial file."""
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+    try:
+        with os.fdopen(fd, 'wb') as fobj:
+            fobj.write(data)
+        os.rename(tmp_path, path)
+    except Exception:
+        os.remove(tmp_path)
+        raise
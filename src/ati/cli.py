@@ -5,15 +5,35 @@ This module provides the ansible cli inventory, according to ansible specs.
 
 """
 import argparse
-import json
+from concurrent.futures import (
+    ThreadPoolExecutor, TimeoutError as FuturesTimeout)
 import os
+import subprocess
+import sys
+import time
+from multiprocessing import cpu_count
 
 from ati import __name__, __version__ 
+from ati.cache import cache_dir, cache_key, write_file
+from ati.codec import dumps, loads
+from ati.hostcache import (
+    MAX_BYTES as HOST_CACHE_BYTES, MAX_OUTPUT_BYTES, HostCache, OutputCache)
 from ati.terraform import (
-    get_stage_root, iterhosts, iterresources,
-    query_host, query_hostfile, query_list, tfstates,
+    PARSERS, PREFETCH_BYTES, PREFETCH_DEPTH, cached_hosts, cached_sources,
+    get_stage_root, iterhosts, iterresources, pool_hosts, prefetch,
+    query_host, query_hostfile, query_list, state_identity, tfstates,
     iter_states)
 
+# how many seconds to let pass between background refreshes, at least
+REFRESH_INTERVAL = 60
+
+# the arguments that change what is printed for the same states
+OUTPUT_ARGS = ('list', 'host', 'hostfile', 'nometa', 'pretty',
+               'aws_name_key', 'aws_ssh_host_key')
+# the arguments that change which states are read
+STATE_ARGS = ('root', 'discovery', 'all_workspaces', 'max_depth', 'noindex')
+
+
 def get_args():
     parser = argparse.ArgumentParser(
         __file__, __doc__,
@@ -35,13 +55,87 @@ def get_args():
     parser.add_argument('--nometa',
                         action='store_true',
                         help='with --list, exclude hostvars')
+    parser.add_argument('--discovery',
+                        choices=['terraform', 'local', 'hybrid'],
+                        default='terraform',
+                        help='where to read states from: `.terraform` dirs, '
+                             'local `.tfstate` files, or the cheapest of both '
+                             'for each directory')
     parser.add_argument('--noterraform',
                         action='store_true',
-                        help='do not use terraform from path')
+                        help='do not use terraform from path (same as '
+                             '`--discovery local`)')
+    parser.add_argument('--jobs',
+                        default=cpu_count(),
+                        type=int,
+                        help='number of `terraform state pull`s to run at once')
+    parser.add_argument('--workers',
+                        default=1,
+                        type=int,
+                        help='number of processes to parse states with')
+    parser.add_argument('--prefetch',
+                        default=PREFETCH_DEPTH,
+                        type=int,
+                        help='number of state files to read ahead of the one '
+                             'being parsed, 0 to read each one as it is '
+                             'parsed')
+    parser.add_argument('--prefetch-memory',
+                        default=PREFETCH_BYTES >> 20,
+                        type=int,
+                        help='megabytes of state files to read ahead of the '
+                             'one being parsed, at most')
+    parser.add_argument('--host-cache',
+                        default=HOST_CACHE_BYTES >> 20,
+                        type=int,
+                        help='megabytes of hosts parsed out of state files to '
+                             'keep for later runs, 0 to parse every state '
+                             'every time')
+    parser.add_argument('--output-cache',
+                        default=MAX_OUTPUT_BYTES >> 20,
+                        type=int,
+                        help='megabytes of output to keep for later runs '
+                             'over the same states, 0 to render it every '
+                             'time')
+    parser.add_argument('--max-depth',
+                        type=int,
+                        help='how many directories deep below the root to '
+                             'look for states')
+    parser.add_argument('--noindex',
+                        action='store_true',
+                        help='walk every directory instead of trusting the '
+                             'directory index of the last run')
+    parser.add_argument('--all-workspaces',
+                        action='store_true',
+                        help='read every workspace of backends that can list '
+                             'them, not just the selected one')
+    parser.add_argument('--mirror-ttl',
+                        type=float,
+                        help='keep a local copy of remote states, and use it '
+                             'without asking their backend for this many '
+                             'seconds after it was fetched')
+    parser.add_argument('--deadline',
+                        type=float,
+                        help='seconds to wait for fresh output before '
+                             'printing the last one, marked stale, and '
+                             'refreshing it in the background')
+    parser.add_argument('--source-timeout',
+                        type=float,
+                        help='seconds to wait for remote states before making '
+                             'do with the copy read last time, marking the '
+                             'output stale')
+    parser.add_argument('--refresh',
+                        action='store_true',
+                        help=argparse.SUPPRESS)
+    parser.add_argument('--timeout',
+                        type=float,
+                        help='seconds to wait for each `terraform state pull`')
     default_root = os.environ.get('TERRAFORM_STATE_ROOT', os.getcwd())
     parser.add_argument('--root',
-                        default=default_root,
-                        help='custom root to search for `.tfstate`s in')
+                        default=default_root.split(os.pathsep),
+                        nargs='+',
+                        help='custom roots to search for `.tfstate`s in. '
+                             'With several roots, every host gets a '
+                             '`terraform_root` var naming the one it is from')
     # extra aws args
     parser.add_argument('--aws_name_key',
                         # also defaulted in ati.terraform.aws_host
@@ -58,35 +152,246 @@ def get_args():
 
     args = parser.parse_args()
 
-    staged_root = get_stage_root(root=args.root)
-    if staged_root != args.root:
-        args.root = staged_root
+    if args.noterraform:
+        args.discovery = 'local'
+
+    args.root = [get_stage_root(root=root) for root in args.root]
 
     return args, parser
 
-def cli():
-    """Package entrypoint and cli."""
-    args, parser = get_args()
 
-    if args.version:
-        print('{} {}'.format(__name__, __version__))
-        parser.exit()
+def root_states(root, args, stale=None):
+    """Yield the states found below `root`.
 
-    if args.noterraform:
-        hosts = iterhosts(iterresources(tfstates(args.root)), args)
-    else:
-        hosts = iterhosts(iterresources(iter_states(args.root)), args)
+    States read from their mirror for being late are added to `stale`.
+
+    """
+    if args.discovery == 'local':
+        return tfstates(root, max_depth=args.max_depth,
+                        index=not args.noindex)
+    ttl = args.mirror_ttl
+    if ttl is None and args.source_timeout is not None:
+        ttl = 0  # keep copies of the states to make do with when they're late
+    return iter_states(root, jobs=args.jobs, timeout=args.timeout,
+                       all_workspaces=args.all_workspaces,
+                       hybrid=args.discovery == 'hybrid',
+                       max_depth=args.max_depth,
+                       index=not args.noindex, ttl=ttl,
+                       source_timeout=None if args.refresh
+                       else args.source_timeout,
+                       stale=stale)
+
+
+def root_hosts(root, args, states=None):
+    """Yield the hosts of the states found below `root`, or of `states`."""
+    if states is None:
+        states = root_states(root, args)
+    cache = None
+    if args.host_cache > 0:
+        try:
+            cache = HostCache(args, args.host_cache << 20)
+        except EnvironmentError:  # no cache to keep the hosts in
+            pass
+        else:
+            states = cached_sources(states, cache)
+    if args.workers > 1:
+        return pool_hosts(states, args, args.workers, cache)
+    if args.prefetch > 0:
+        states = prefetch(states, args.prefetch, args.prefetch_memory << 20)
+    if cache is not None:
+        return cached_hosts(states, args, cache)
+    return iterhosts(iterresources(states, types=PARSERS), args)
+
+
+def federated_hosts(args, states=None):
+    """Yield the hosts below every root, along with the root they are from.
+
+    Roots are scanned concurrently, and their hosts merged in root order.
+    The states of every root are read from `states` when they have been found
+    already.
+
+    """
+    def scan(root, root_states):
+        return list(root_hosts(root, args, root_states))
+
+    with ThreadPoolExecutor(max_workers=len(args.root)) as executor:
+        for root, hosts in zip(args.root, executor.map(
+                scan, args.root, states or [None] * len(args.root))):
+            for name, attrs, groups in hosts:
+                attrs['terraform_root'] = root
+                yield name, attrs, groups
+
+
+def find_states(args, stale=None):
+    """Return the states found below each root, concurrently."""
+    def find(root):
+        return list(root_states(root, args, stale))
+
+    with ThreadPoolExecutor(max_workers=len(args.root)) as executor:
+        return list(executor.map(find, args.root))
+
+
+def output_options(args):
+    """Return the arguments the output for `args` is kept under.
+
+    The states read are part of the key of the output already, but not of
+    the last output printed, which is served past a `--deadline`: that has
+    to be for the same states as well as the same arguments.
+
+    """
+    return dict((name, getattr(args, name))
+                for name in OUTPUT_ARGS + STATE_ARGS)
+
+
+def output_cache(args):
+    """Return the `OutputCache` for `args`, or None when there is none.
+
+    There is none when `--output-cache` is 0, nor when the cache directory
+    can't be made: the output is rendered every time then.
 
+    """
+    if args.output_cache > 0:
+        try:
+            return OutputCache(args.output_cache << 20)
+        except EnvironmentError:
+            pass
+    return None
+
+
+def render(hosts, args):
+    """Return what is printed for `hosts`, as bytes."""
     if args.list:
         output = query_list(hosts)
         if args.nometa:
             del output['_meta']
-        print(json.dumps(output, indent=4 if args.pretty else None))
+        output = dumps(output, indent=4 if args.pretty else None)
     elif args.host:
         output = query_host(hosts, args.host)
-        print(json.dumps(output, indent=4 if args.pretty else None))
-    elif args.hostfile:
+        output = dumps(output, indent=4 if args.pretty else None)
+    else:
         output = query_hostfile(hosts)
-        print(output)
+    return (output + u'\n').encode('utf-8')
+
+
+def inventory(args, stale=None):
+    """Return what is printed for `args`, as bytes.
+
+    The output of an earlier run is reused when none of the states it was
+    made from changed since. States read from their mirror for being late
+    are added to `stale`.
+
+    """
+    states = find_states(args, stale)
+    cache = output_cache(args)
+    if cache is not None:
+        entry_path = cache.entry_path(
+            [[state_identity(state) for state in found] for found in states],
+            output_options(args))
+        output = cache.get(entry_path)
+        if output is not None:
+            cache.remember(output_options(args), entry_path)
+            return output
+
+    if len(args.root) > 1:
+        hosts = federated_hosts(args, states)
+    else:
+        hosts = root_hosts(args.root[0], args, states[0])
+
+    output = render(hosts, args)
+    if cache is not None:
+        cache.put(entry_path, output)
+        cache.remember(output_options(args), entry_path)
+    return output
+
+
+def serve(args):
+    """Return what is printed for `args`, and whether it is stale.
+
+    With a `--deadline`, the last output printed for the same arguments is
+    returned if the fresh one isn't ready in time, and is stale. So is output
+    made from states that were read from their mirror for being late.
+
+    """
+    stale = []
+    if args.deadline is None or args.refresh:
+        output = inventory(args, stale)
+        return output, bool(stale)
+
+    executor = ThreadPoolExecutor(max_workers=1)
+    future = executor.submit(inventory, args, stale)
+    executor.shutdown(wait=False)
+    try:
+        output = future.result(timeout=args.deadline)
+    except FuturesTimeout:
+        last, cache = None, output_cache(args)
+        if cache is not None:
+            last = cache.last(output_options(args))
+        if last is not None:
+            return last, True
+        output = future.result()  # nothing to make do with
+    return output, bool(stale)
+
+
+def mark_stale(output, args):
+    """Flag `--list` output as stale, with `"stale": true` in its `_meta`."""
+    if not args.list:
+        return output
+    listing = loads(output)
+    listing.setdefault('_meta', {})['stale'] = True
+    return (dumps(listing, indent=4 if args.pretty else None) +
+            u'\n').encode('utf-8')
+
+
+def refresh(args):
+    """Start building the output for `args` in a detached process.
+
+    Nothing is printed, but the output and the states read are cached for
+    the next run. At most one refresh is started every `REFRESH_INTERVAL`
+    seconds for the same arguments.
+
+    """
+    try:
+        marker = os.path.join(cache_dir('refresh'),
+                              cache_key(dumps(output_options(args))))
+    except EnvironmentError:
+        return  # the output couldn't be kept for the next run anyway
+    try:
+        if 0 <= time.time() - os.path.getmtime(marker) < REFRESH_INTERVAL:
+            return
+    except OSError:
+        pass
+    try:
+        write_file(marker, b'')
+    except EnvironmentError:
+        return
+
+    command = [sys.executable, '-c', 'from ati.cli import cli; cli()']
+    with open(os.devnull, 'r+b') as devnull:
+        subprocess.Popen(command + sys.argv[1:] + ['--refresh'],
+                         stdin=devnull, stdout=devnull, stderr=devnull,
+                         close_fds=True,
+                         preexec_fn=getattr(os, 'setsid', None))
+
+
+def cli():
+    """Package entrypoint and cli."""
+    args, parser = get_args()
+
+    if args.version:
+        print('{} {}'.format(__name__, __version__))
+        parser.exit()
+
+    output, stale = serve(args)
+    if args.refresh:
+        parser.exit()
+    if stale:
+        output = mark_stale(output, args)
+        refresh(args)
 
+    stdout = getattr(sys.stdout, 'buffer', sys.stdout)
+    stdout.write(output)
+    if stale:
+        # leave without waiting for the states that were late
+        stdout.flush()
+        os._exit(0)
     parser.exit()
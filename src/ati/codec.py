@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+"""JSON decoding and encoding, through orjson when it is installed.
+
+orjson decodes states and encodes inventories several times faster than the
+`json` module, and reads bytes without having them decoded to text first.
+Whatever it turns down (`NaN` in a document, keys that aren't strings) goes
+through the `json` module instead, so results don't depend on which one is
+installed, save for integers over 64 bits, which orjson decodes as floats.
+
+"""
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def _std_loads(data):
+    if isinstance(data, memoryview):
+        data = data.tobytes()
+    if isinstance(data, (bytes, bytearray)):
+        data = data.decode('utf-8')
+    return json.loads(data)
+
+
+def loads(data):
+    """Decode a JSON document from `data` (text, or bytes in UTF-8)."""
+    if orjson is not None:
+        try:
+            return orjson.loads(data)
+        except orjson.JSONDecodeError:
+            pass
+    return _std_loads(data)
+
+
+def dumps(obj, indent=None):
+    """Encode `obj` as JSON text.
+
+    orjson only indents by two spaces, so other indents go through `json`.
+
+    """
+    if orjson is not None and indent in (None, 2):
+        option = orjson.OPT_NON_STR_KEYS
+        if indent:
+            option |= orjson.OPT_INDENT_2
+        try:
+            return orjson.dumps(obj, option=option).decode('utf-8')
+        except TypeError:
+            pass
+    return json.dumps(obj, indent=indent)
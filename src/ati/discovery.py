@@ -0,0 +1,163 @@
+# -*- coding: utf-8 -*-
+"""Walk the directories below a root, skipping those that can't hold states.
+
+Terraform roots tend to sit next to (or contain) huge trees that never hold a
+state: VCS metadata, `.terragrunt-cache`, `node_modules`, vendored code, and
+the plugins and modules terraform downloads into `.terraform`. `walk` never
+descends into those, nor into anything matched by the glob patterns in the
+root's `.atiignore` file.
+
+Walks can also keep an index of every directory they list in the cache. A
+directory's mtime changes whenever entries are added to or removed from it, so
+the next walk only has to stat the directories it already knows about, and
+only lists those whose mtime changed.
+
+"""
+from fnmatch import fnmatch
+import os
+import time
+
+try:
+    from os import scandir
+except ImportError:  # python < 3.5
+    from scandir import scandir
+
+from ati.cache import cache_dir, cache_key, read_file, write_file
+from ati.codec import dumps, loads
+
+IGNORE_FILE = '.atiignore'
+PRUNED = frozenset([
+    '.git', '.hg', '.svn', '.terragrunt-cache', '.tox', '__pycache__',
+    'node_modules', 'vendor'])
+
+
+def read_ignore(root):
+    """Return the glob patterns listed in the `.atiignore` file of `root`."""
+    try:
+        with open(os.path.join(root, IGNORE_FILE)) as ignore_file:
+            lines = [line.strip() for line in ignore_file]
+    except (IOError, OSError):
+        return []
+
+    return [line.rstrip('/') for line in lines
+            if line and not line.startswith('#')]
+
+
+def is_ignored(relpath, patterns):
+    """Tell whether `relpath` (relative to the root) matches any pattern."""
+    name = relpath.rsplit('/', 1)[-1]
+    return any(fnmatch(relpath, pattern) or fnmatch(name, pattern)
+               for pattern in patterns)
+
+
+def _listdir(dpath, prefix, patterns):
+    dirnames, filenames, links = [], [], set()
+    try:
+        entries = list(scandir(dpath))
+    except OSError:
+        return dirnames, filenames, links
+
+    for entry in entries:
+        if patterns and is_ignored(prefix + entry.name, patterns):
+            continue
+        try:
+            if entry.is_dir():
+                dirnames.append(entry.name)
+                if entry.is_symlink():
+                    links.add(entry.name)
+            else:
+                filenames.append(entry.name)
+        except OSError:
+            continue
+    return sorted(dirnames), sorted(filenames), links
+
+
+class Index(object):
+    """Directory listings of a previous walk, keyed by directory and mtime."""
+
+    def __init__(self, path):
+        self.path = path
+        self.started = time.time()
+        self.changed = False
+        try:
+            index = loads(read_file(path))
+            self.saved, self.dirs = index['saved'], index['dirs']
+        except (AttributeError, KeyError, TypeError, ValueError):
+            self.saved, self.dirs = 0, {}
+        self.seen = {}
+
+    @classmethod
+    def for_walk(cls, root, max_depth, patterns):
+        key = cache_key(os.path.abspath(root), str(max_depth), *patterns)
+        return cls(os.path.join(cache_dir('discovery'), key + '.json'))
+
+    def listdir(self, dpath, prefix, patterns):
+        try:
+            mtime = os.stat(dpath).st_mtime
+        except OSError:
+            mtime = None
+
+        known = self.dirs.get(dpath)
+        # a directory changed in the same second the index was saved might
+        # change again without its mtime moving on, so list it again
+        if known and mtime is not None and known[0] == mtime and \
+           mtime < self.saved - 1:
+            dirnames, filenames, links = known[1], known[2], set(known[3])
+        else:
+            self.changed = True
+            dirnames, filenames, links = _listdir(dpath, prefix, patterns)
+
+        self.seen[dpath] = [mtime, dirnames, filenames, sorted(links)]
+        return list(dirnames), list(filenames), links
+
+    def save(self):
+        if self.changed or set(self.seen) != set(self.dirs):
+            try:
+                write_file(self.path, dumps(
+                    {'saved': self.started, 'dirs': self.seen}
+                ).encode('utf-8'))
+            except EnvironmentError:
+                pass  # the next walk lists every directory, that's all
+
+
+def walk(root, max_depth=None, ignore=None, index=False):
+    """Walk `root` top-down like `os.walk`, but prune what can't hold states.
+
+    Yields `(dirpath, dirnames, filenames)` in sorted order. Like `os.walk`,
+    symlinked directories are listed but not followed, and removing names
+    from `dirnames` keeps the walk out of them.
+
+    Args:
+        root (str): Directory to walk.
+        max_depth (int): How deep below `root` to go, unlimited when None.
+        ignore (list): Glob patterns to skip, read from `.atiignore` when None.
+        index (bool): Reuse and update the directory index in the cache,
+            when the cache can be written to.
+
+    """
+    patterns = read_ignore(root) if ignore is None else ignore
+    dir_index, listdir = None, _listdir
+    if index:
+        try:
+            dir_index = Index.for_walk(root, max_depth, patterns)
+        except EnvironmentError:  # no cache to keep it in, walk without it
+            pass
+        else:
+            listdir = dir_index.listdir
+
+    stack = [(root, '', 0)]
+    while stack:
+        dpath, prefix, depth = stack.pop()
+        dirnames, filenames, links = listdir(dpath, prefix, patterns)
+        yield dpath, dirnames, filenames
+
+        if os.path.basename(dpath) == '.terraform' or \
+           (max_depth is not None and depth >= max_depth):
+            continue
+        for name in reversed(dirnames):
+            if name not in PRUNED and name not in links:
+                stack.append((os.path.join(dpath, name), prefix + name + '/',
+                              depth + 1))
+
+    if dir_index:
+        dir_index.save()
@@ -5,3 +5,8 @@
 class InvalidRemoteError(Exception):
     """When data is invalid for the chosen remote."""
     pass
+
+
+class StatePullError(Exception):
+    """When `terraform state pull` fails or times out."""
+    pass
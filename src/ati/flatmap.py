@@ -0,0 +1,238 @@
+# -*- coding: utf-8 -*-
+"""Resource attributes, as terraform flattens them into `tags.Name` keys.
+
+Up to terraform 0.11, states hold the attributes of a resource as a flat dict
+of strings (a "flatmap"), where lists and maps are spread over keys like
+`network.0.name` and `tags.Name`, next to `network.#` and `tags.%` counts.
+From terraform 0.12 on, they are typed JSON instead, which `TypedAttributes`
+reads the same way.
+
+"""
+from collections import defaultdict
+from numbers import Number
+
+# keys terraform keeps the number of elements of a list (`#`) or map (`%`) in
+COUNT_KEYS = frozenset(['#', '%'])
+
+
+def _group(source, sep):
+    groups = defaultdict(list)
+    for compkey, value in source.items():
+        curprefix, found, rest = compkey.partition(sep)
+        if found and rest not in COUNT_KEYS:
+            groups[curprefix].append((rest, value))
+    return groups
+
+
+class ExtractionPlan(object):
+    """The prefixes a parser looks up, learned from the resources it parsed.
+
+    Resources of the same type and schema version have the same keys, give or
+    take list indexes and set hashes, and their parser looks up the same
+    prefixes in each of them. Once the plan knows those prefixes, only the
+    keys below them are grouped, and keys seen before aren't split again.
+
+    """
+
+    # how many splits to remember, keys with set hashes in them being unique
+    MAX_KEYS = 4096
+
+    def __init__(self):
+        self.compiled = {}  # sep: (prefixes looked up, {compkey: split})
+
+    def learn(self, sep, prefix):
+        prefixes, _ = self.compiled.get(sep, (frozenset(), None))
+        if prefix not in prefixes:
+            # start over rather than change what other threads may be using
+            self.compiled[sep] = (prefixes | frozenset([prefix]), {})
+
+    def group(self, source, sep):
+        """Group the keys of `source` below the prefixes learned for `sep`.
+
+        Returns the groups along with the prefixes they cover.
+
+        """
+        try:
+            prefixes, splits = self.compiled[sep]
+        except KeyError:
+            return {}, frozenset()
+        groups = defaultdict(list)
+        for compkey, value in source.items():
+            try:
+                split = splits[compkey]
+            except KeyError:
+                curprefix, found, rest = compkey.partition(sep)
+                split = None
+                if found and curprefix in prefixes and \
+                   rest not in COUNT_KEYS:
+                    split = curprefix, rest
+                if len(splits) < self.MAX_KEYS:
+                    splits[compkey] = split
+            if split is not None:
+                groups[split[0]].append((split[1], value))
+        return groups, prefixes
+
+
+class FlatMap(dict):
+    """Resource attributes, as flattened by terraform into `tags.Name` keys.
+
+    The first time a prefix is looked up, every key is split on `sep` in a
+    single pass, grouping keys by prefix. Looking up the other prefixes then
+    costs no more than the number of keys they hold. With a `plan`, only the
+    keys below the prefixes it knows of are grouped. Values are meant to be
+    read, not changed.
+
+    """
+
+    def __init__(self, items=(), plan=None):
+        super(FlatMap, self).__init__(items)
+        self.plan = plan
+        self._groups = {}  # sep: (groups, prefixes covered or None for all)
+
+    def __reduce__(self):
+        # only the attributes themselves, not what was worked out from them
+        return self.__class__, (list(dict.items(self)),)
+
+    def prefixed(self, prefix, sep='.'):
+        """Return the `(rest, value)` pairs of the keys below `prefix`."""
+        try:
+            groups, covered = self._groups[sep]
+        except KeyError:
+            if self.plan is not None:
+                groups, covered = self.plan.group(self, sep)
+            else:
+                groups, covered = _group(self, sep), None
+            self._groups[sep] = groups, covered
+
+        if covered is None:
+            if self.plan is not None:
+                self.plan.learn(sep, prefix)
+        elif prefix not in covered:
+            # new to the plan, so the next resource will be planned with it
+            self.plan.learn(sep, prefix)
+            groups, covered = self._groups[sep] = _group(self, sep), None
+        return groups.get(prefix, ())
+
+
+def _text(value):
+    """Return a typed value the way a flatmap would have held it."""
+    if value is True:
+        return 'true'
+    if value is False:
+        return 'false'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    if isinstance(value, Number):
+        return str(value)
+    return value
+
+
+def flatten(value, prefix=''):
+    """Yield the flatmap `(key, value)` pairs of a typed list or map."""
+    if isinstance(value, dict):
+        yield prefix + '%', str(len(value))
+        items = value.items()
+    else:
+        yield prefix + '#', str(len(value))
+        items = enumerate(value)
+
+    for key, item in items:
+        if isinstance(item, dict) and isinstance(value, list):
+            # a nested block, which flatmaps never counted the keys of
+            for pair in list(flatten(item, u'{}{}.'.format(prefix, key)))[1:]:
+                yield pair
+        elif isinstance(item, (dict, list)):
+            for pair in flatten(item, u'{}{}.'.format(prefix, key)):
+                yield pair
+        elif item is not None:
+            yield u'{}{}'.format(prefix, key), _text(item)
+
+
+def _walk(value, parts):
+    last = len(parts) - 1
+    for idx, part in enumerate(parts):
+        if isinstance(value, dict):
+            # map keys may hold dots of their own
+            rest = '.'.join(parts[idx:])
+            if rest in value:
+                return value[rest]
+            if part == '%' and idx == last:
+                return len(value)
+            value = value.get(part)
+        elif isinstance(value, list):
+            if part == '#' and idx == last:
+                return len(value)
+            try:
+                value = value[int(part)]
+            except (IndexError, ValueError):
+                return None
+        else:
+            return None
+    return value
+
+
+class TypedAttributes(FlatMap):
+    """The typed attributes of a resource in a v4 state, read as a flatmap.
+
+    Terraform 0.12 and later keep lists and maps as they are. Keys such as
+    `tags.Name` or `network.#` are found by walking those values, and looking
+    up a prefix only flattens the value below it, so parsers written for
+    flatmaps work unchanged without every key being flattened and split
+    again. Values come back as the strings a flatmap would have held.
+
+    """
+
+    def _find(self, key):
+        value = dict.get(self, key)
+        if value is None and '.' in key:
+            parts = key.split('.')
+            value = _walk(dict.get(self, parts[0]), parts[1:])
+        if value is None or isinstance(value, (dict, list)):
+            raise KeyError(key)
+        return _text(value)
+
+    def __getitem__(self, key):
+        return self._find(key)
+
+    def __contains__(self, key):
+        try:
+            self._find(key)
+        except KeyError:
+            return False
+        return True
+
+    def get(self, key, default=None):
+        try:
+            return self._find(key)
+        except KeyError:
+            return default
+
+    def items(self):
+        pairs = []
+        for key, value in dict.items(self):
+            if isinstance(value, (dict, list)):
+                pairs.extend(flatten(value, key + '.'))
+            elif value is not None:
+                pairs.append((key, _text(value)))
+        return pairs
+
+    def keys(self):
+        return [key for key, _ in self.items()]
+
+    def values(self):
+        return [value for _, value in self.items()]
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.items())
+
+    def prefixed(self, prefix, sep='.'):
+        if sep != '.':
+            return super(TypedAttributes, self).prefixed(prefix, sep)
+        value = dict.get(self, prefix)
+        if not isinstance(value, (dict, list)):
+            return ()
+        return [(key, item) for key, item in flatten(value)
+                if key not in COUNT_KEYS]
@@ -0,0 +1,287 @@
+# -*- coding: utf-8 -*-
+"""The hosts parsed out of state files, kept from one run to the next.
+
+Most states change a few times a week, while Ansible asks for the inventory
+many times an hour. The hosts of every state file parsed are kept in the ati
+cache, keyed by the path of the state and the arguments the parsers look at,
+and handed out as they are for as long as the size, mtime, lineage and serial
+of the state file stay those they were parsed from.
+
+A state that did change is seldom changed much. The hosts parsed out of each
+of its resources are kept too, keyed by a hash of the resource, so only the
+resources that are new or changed since the last run are parsed again.
+
+Entries are replaced in place when a state changes. Once a run has written
+any, the least recently used entries are dropped until all of them add up to
+no more than the size the cache is allowed.
+
+Inventories are kept as they were printed as well, keyed by all the states
+they were made from and the arguments that change them, so that a run over
+states that didn't change prints what the last one did, without parsing or
+rendering anything.
+
+"""
+import hashlib
+import os
+
+from ati import __version__
+from ati.cache import cache_dir, cache_key, read_file, write_file
+from ati.codec import dumps, loads
+from ati.stream import file_header
+
+# how many bytes of hosts to keep, all state files together
+MAX_BYTES = 64 << 20
+# how many bytes of printed inventories to keep
+MAX_OUTPUT_BYTES = 256 << 20
+
+# the arguments that change what parsers make out of a state
+ARGS = ('aws_name_key', 'aws_ssh_host_key')
+
+
+def state_identity(path, data=None):
+    """Return what has to stay the same for the hosts of `path` to be valid.
+
+    When the file has been read already, its size, serial and lineage are
+    taken from the `data` read, which is what the hosts will be parsed from.
+
+    """
+    stat = os.stat(path)
+    header = file_header(path, data)
+    return {'size': stat.st_size if data is None else len(data),
+            'mtime': stat.st_mtime,
+            'serial': header.get('serial'),
+            'lineage': header.get('lineage')}
+
+
+class ResourceMemo(object):
+    """Hosts parsed out of the resources of one state, by resource hash.
+
+    Hosts are kept as JSON text, and only decoded when they are used. Saving
+    the memo keeps only the hosts used or added since it was read, so it
+    never grows past the resources the state has.
+
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.current = {}
+        try:
+            self.previous = loads(read_file(path))
+        except (TypeError, ValueError):
+            self.previous = None
+        if not isinstance(self.previous, dict):
+            self.previous = {}
+
+    @staticmethod
+    def digest(module_name, resource_type, resource):
+        """Hash what a host is parsed out of.
+
+        The parser is the one for `resource_type`, in the ati version and
+        with the arguments the memo is for.
+
+        """
+        return hashlib.sha1(dumps(
+            [module_name, resource_type, resource]).encode('utf-8')
+        ).hexdigest()
+
+    def get(self, digest):
+        """Return the host parsed out of the resource hashed, or None.
+
+        None is also returned for resources that had no host, which are
+        cheap enough to parse again.
+
+        """
+        text = self.current.get(digest) or self.previous.pop(digest, None)
+        if text is None:
+            return None
+        self.current[digest] = text
+        host = loads(text.encode('utf-8'))
+        return None if host is None else tuple(host)
+
+    def put(self, digest, host):
+        self.current[digest] = dumps(host)
+
+
+class HostCache(object):
+    """Hosts of the state files parsed in earlier runs.
+
+    Args:
+        args (argparse.Namespace): What the hosts are parsed with. Only the
+            attributes in `ARGS` are part of the key.
+        max_bytes (int): How large all the entries may get, together.
+
+    """
+
+    def __init__(self, args, max_bytes=MAX_BYTES):
+        self.args = [u'{}={}'.format(name, getattr(args, name, None))
+                     for name in ARGS]
+        self.max_bytes = max_bytes
+        self.directory = cache_dir('hosts')
+
+    def entry_path(self, path):
+        key = cache_key(os.path.abspath(path), __version__, *self.args)
+        return os.path.join(self.directory, key + '.json')
+
+    def identity(self, path, data=None):
+        """Return the identity of the state file `path`, or None.
+
+        State files that can't be read have no identity, and aren't cached.
+
+        """
+        try:
+            return state_identity(path, data)
+        except (EnvironmentError, ValueError):
+            return None
+
+    def memo(self, scope):
+        """Return the `ResourceMemo` of the state known as `scope`.
+
+        States are known by their lineage, which stays the same through
+        every change of the state, or by their path if they have none.
+
+        """
+        key = cache_key(u'resources', scope, __version__, *self.args)
+        return ResourceMemo(os.path.join(self.directory, key + '.json'))
+
+    def save(self, memo):
+        """Write `memo` out, for the next time its state is parsed.
+
+        Memos count towards the size of the cache, but are left for the
+        eviction at the end of the run like the other entries. Memos that
+        can't be written are dropped.
+
+        """
+        try:
+            write_file(memo.path, dumps(memo.current).encode('utf-8'))
+        except EnvironmentError:
+            pass
+
+    def get(self, path, identity):
+        """Return the hosts kept for `path`, or None if they are stale."""
+        entry_path = self.entry_path(path)
+        try:
+            entry = loads(read_file(entry_path))
+            if entry['identity'] != identity:
+                return None
+            hosts = [tuple(host) for host in entry['hosts']]
+        except (AttributeError, KeyError, TypeError, ValueError):
+            return None
+        try:
+            os.utime(entry_path, None)  # the mtime marks the last use
+        except OSError:
+            pass
+        return hosts
+
+    def put(self, path, identity, hosts):
+        """Keep the `hosts` parsed out of `path` while it had `identity`.
+
+        The hosts are parsed again next time if they can't be written.
+
+        """
+        if identity is None:
+            return
+        try:
+            write_file(self.entry_path(path), dumps(
+                {'identity': identity, 'hosts': hosts}).encode('utf-8'))
+        except EnvironmentError:
+            pass
+
+    def evict(self):
+        """Drop the least recently used entries until the rest fit.
+
+        Entries are written without looking at the others, which means
+        listing the whole cache: this is done once, after they are written.
+
+        """
+        evict(self.directory, self.max_bytes)
+
+
+class OutputCache(object):
+    """Inventories as they were printed, keyed by all they were made from.
+
+    Args:
+        max_bytes (int): How large all the entries may get, together.
+
+    """
+
+    def __init__(self, max_bytes=MAX_OUTPUT_BYTES):
+        self.max_bytes = max_bytes
+        self.directory = cache_dir('output')
+
+    def entry_path(self, identities, options):
+        """Return where the output for states and options is kept.
+
+        Args:
+            identities (list): What identifies each state read, in order.
+            options (dict): The arguments that change the output.
+
+        """
+        key = cache_key(__version__, dumps(identities), dumps(options))
+        return os.path.join(self.directory, key)
+
+    def last_path(self, options):
+        key = cache_key(__version__, u'last', dumps(options))
+        return os.path.join(self.directory, key)
+
+    def get(self, entry_path):
+        """Return the output kept in `entry_path`, or None."""
+        output = read_file(entry_path)
+        if output is not None:
+            try:
+                os.utime(entry_path, None)  # the mtime marks the last use
+            except OSError:
+                pass
+        return output
+
+    def put(self, entry_path, output):
+        """Keep `output` in `entry_path`, unless it can't be written."""
+        try:
+            write_file(entry_path, output)
+        except EnvironmentError:
+            return
+        evict(self.directory, self.max_bytes)
+
+    def remember(self, options, entry_path):
+        """Note `entry_path` as the last output printed for `options`."""
+        try:
+            write_file(self.last_path(options),
+                       os.path.basename(entry_path).encode('utf-8'))
+        except EnvironmentError:
+            pass
+
+    def last(self, options):
+        """Return the last output printed for `options`, or None.
+
+        That is the output of the last run with those options, whatever the
+        states were then.
+
+        """
+        name = read_file(self.last_path(options))
+        if name is None:
+            return None
+        return self.get(os.path.join(self.directory, name.decode('utf-8')))
+
+
+def evict(directory, max_bytes):
+    """Drop the least recently used files in `directory` until the rest fit."""
+    entries = []
+    try:
+        names = os.listdir(directory)
+    except OSError:
+        return  # dropped by another run, or never made
+    for name in names:
+        try:
+            stat = os.stat(os.path.join(directory, name))
+        except OSError:
+            continue  # dropped by another run
+        entries.append((stat.st_mtime, stat.st_size, name))
+
+    total = sum(size for _, size, _ in entries)
+    for _, size, name in sorted(entries):
+        if total <= max_bytes:
+            break
+        try:
+            os.remove(os.path.join(directory, name))
+        except OSError:
+            pass
+        total -= size
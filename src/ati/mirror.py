@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+"""Local copies of remote states.
+
+Reading a remote state means asking its backend, or terraform, for it on
+every run. The mirror keeps a copy of every remote state read as a state file
+in the ati cache, along with its serial, lineage and when it was fetched.
+For a while after that (the TTL), the copy is used as is and the backend
+isn't asked at all. Past it, the state is read again, and the copy is only
+rewritten when its serial or lineage differ, so that whatever is kept about
+the file itself, like its hosts, stays valid.
+
+"""
+import os
+import time
+
+from ati.cache import cache_dir, cache_key, read_file, write_file
+from ati.codec import dumps, loads
+
+
+class Mirror(object):
+    """The local copy of one remote state, known by `parts`."""
+
+    def __init__(self, *parts):
+        base = os.path.join(cache_dir('mirror'), cache_key(*parts))
+        self.path = base + '.tfstate'
+        self.meta_path = base + '.json'
+        try:
+            self.meta = loads(read_file(self.meta_path))
+        except (TypeError, ValueError):
+            self.meta = None
+        if not isinstance(self.meta, dict) or not os.path.exists(self.path):
+            self.meta = None
+
+    def fresh(self, ttl):
+        """Tell whether the copy was fetched less than `ttl` seconds ago."""
+        if self.meta is None:
+            return False
+        return 0 <= time.time() - self.meta.get('fetched', 0) < ttl
+
+    def update(self, state):
+        """Mirror `state`, fetched just now, and return the path of the copy.
+
+        The copy is left alone when it has the serial and lineage of `state`
+        already: terraform bumps the serial on every change.
+
+        """
+        header = {'serial': state.get('serial'),
+                  'lineage': state.get('lineage')}
+        if None in header.values() or self.meta is None or \
+           any(self.meta.get(key) != value for key, value in header.items()):
+            write_file(self.path, dumps(state).encode('utf-8'))
+        self.meta = dict(header, fetched=time.time())
+        write_file(self.meta_path, dumps(self.meta).encode('utf-8'))
+        return self.path
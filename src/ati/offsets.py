@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+"""Byte offsets of the resources we parse in large state files.
+
+Even streamed, a state file has to be scanned from start to end to find the
+handful of resources we have parsers for among the thousands we don't. The
+first scan of a large state file records where each of those resources starts
+and ends, so later runs can seek straight to them and decode nothing else.
+
+Indexes live in the ati cache rather than next to the state files, keyed by
+the path of the state and the resource types asked for, and are only trusted
+while the size, mtime and serial of the state file are those they were built
+from.
+
+"""
+from contextlib import contextmanager
+import os
+
+from ati.cache import cache_dir, cache_key, read_file, write_file
+from ati.codec import dumps, loads
+from ati.stream import (
+    Scanner, file_header, instance_resource, iter_resources, scan_file)
+
+# below this, scanning the whole file is about as quick as reading an index
+MIN_SIZE = 1 << 20
+
+
+def file_identity(path, data=None):
+    """Return what has to stay the same for an index of `path` to be valid.
+
+    When the file has been read already, its size and serial are taken from
+    the `data` read, which is what the index will be used with.
+
+    """
+    stat = os.stat(path)
+    if data is None:
+        return {'size': stat.st_size, 'mtime': stat.st_mtime,
+                'serial': file_header(path).get('serial')}
+    return {'size': len(data), 'mtime': stat.st_mtime,
+            'serial': file_header(path, data).get('serial')}
+
+
+def index_path(path, types):
+    key = cache_key(os.path.abspath(path), *sorted(types))
+    return os.path.join(cache_dir('offsets'), key + '.json')
+
+
+def read_index(path, types, identity):
+    """Return the offsets indexed for `path`, or None if they are stale."""
+    try:
+        index = loads(read_file(index_path(path, types)))
+        if index['identity'] == identity:
+            return index['offsets']
+    except (AttributeError, KeyError, TypeError, ValueError):
+        pass
+    return None
+
+
+def write_index(path, types, identity, offsets):
+    write_file(index_path(path, types), dumps(
+        {'identity': identity, 'offsets': offsets}).encode('utf-8'))
+
+
+@contextmanager
+def _opened(path, data):
+    if data is not None:
+        yield None
+        return
+    with open(path, 'rb') as state_file:
+        yield state_file
+
+
+@contextmanager
+def _scanner(path, data):
+    if data is not None:
+        yield Scanner(data=data)
+        return
+    with scan_file(path) as scanner:
+        yield scanner
+
+
+def read_resources(path, offsets, data=None):
+    """Yield `(module_name, key, resource)` for the `offsets` of an index.
+
+    The resources are read from `data` instead of `path` when the file has
+    been read already.
+
+    """
+    with _opened(path, data) as state_file:
+        for entry in offsets:
+            name, key, start, end = entry[:4]
+            if data is None:
+                state_file.seek(start)
+                raw = state_file.read(end - start)
+            else:
+                raw = data[start:end]
+            resource = loads(raw)
+            if len(entry) > 4:  # an instance in a v4 state
+                resource = instance_resource(entry[4], resource)
+            yield name, key, resource
+
+
+def current_offsets(path, types):
+    """Return the indexed offsets of `path`, or None if they are stale."""
+    return read_index(path, types, file_identity(path))
+
+
+def indexed_resources(path, types, wanted, data=None):
+    """Yield `(module_name, key, resource)` for resources of `types` in `path`.
+
+    Resources are read from the offsets in the index when it is up to date.
+    Otherwise the file is streamed, keeping only the resources `wanted`
+    accepts, and the index is rebuilt along the way.
+
+    Args:
+        path (str): State file to read resources from.
+        types (container): Resource types to index.
+        wanted (callable): Tells resource keys of `types` from the others.
+        data (bytes): The contents of `path`, if they have been read already.
+
+    """
+    identity = file_identity(path, data)
+    offsets = read_index(path, types, identity)
+    if offsets is not None:
+        for resource in read_resources(path, offsets, data):
+            yield resource
+        return
+
+    offsets = []
+    with _scanner(path, data) as scanner:
+        for resource in iter_resources(scanner, wanted, offsets):
+            yield resource
+    # the identity is the one from before the scan: if the file changed while
+    # we were reading it, the index will simply be stale next time around.
+    # Resources read out of order have no offsets, and leave nothing to index
+    if all(entry[2] is not None for entry in offsets):
+        write_index(path, types, identity, offsets)
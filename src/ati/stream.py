@@ -0,0 +1,423 @@
+# -*- coding: utf-8 -*-
+"""Incremental reading of terraform state files.
+
+`json.load` builds the whole state before the first host comes out of it,
+which for states full of security group rules and IAM policies means hundreds
+of megabytes. The `Scanner` here reads a state in chunks instead, and only
+decodes one value at a time: memory use depends on the largest resource in
+the state, not on the size of the state.
+
+"""
+from contextlib import contextmanager
+import json
+import mmap
+import re
+
+from ati.codec import loads
+from ati.flatmap import FlatMap, TypedAttributes
+
+CHUNK_SIZE = 64 * 1024
+
+_HEADER = re.compile(br'"(serial|lineage)"\s*:\s*("[^"]*"|\d+)')
+_WS = re.compile(br'[ \t\n\r]*')
+_SCALAR = re.compile(br'[^,:\]}\s]+')
+_STRING = re.compile(br'"[^"\\]*(?:\\.[^"\\]*)*"')
+# everything up to the next bracket that isn't part of a string, or to the
+# start of a string that runs past the end of what we have read so far
+_BODY = re.compile(br'(?:[^"{}\[\]]+|"[^"\\]*(?:\\.[^"\\]*)*")*')
+
+
+class Scanner(object):
+    """A window over a JSON document, read from `fobj` one chunk at a time.
+
+    The document may also be passed as `data` (anything supporting the buffer
+    protocol, like `bytes` or an `mmap`) when it is in memory already.
+
+    """
+
+    def __init__(self, fobj=None, data=None, chunk_size=CHUNK_SIZE):
+        self.fobj = fobj
+        self.chunk_size = chunk_size
+        self.buf = bytearray() if data is None else data
+        self.eof = data is not None
+        self.base = 0  # offset in the document of buf[0]
+        self.pos = 0
+
+    def _more(self):
+        if self.eof:
+            return False
+        chunk = self.fobj.read(max(self.chunk_size, len(self.buf)))
+        if not chunk:
+            self.eof = True
+            return False
+        self.buf += chunk
+        return True
+
+    def release(self):
+        """Forget everything before the current position."""
+        if self.fobj is not None and self.pos >= self.chunk_size:
+            del self.buf[:self.pos]
+            self.base += self.pos
+            self.pos = 0
+
+    def ws(self):
+        """Skip whitespace, and return the next character."""
+        while True:
+            self.pos = _WS.match(self.buf, self.pos).end()
+            if self.pos < len(self.buf) or not self._more():
+                return self.buf[self.pos:self.pos + 1]
+
+    def expect(self, char):
+        if self.ws() != char:
+            raise ValueError('expected {!r} at offset {}'.format(
+                char, self.base + self.pos))
+        self.pos += 1
+
+    def _string_end(self, i):
+        while True:
+            match = _STRING.match(self.buf, i)
+            if match:
+                return match.end()
+            if not self._more():
+                raise ValueError('unterminated string at offset {}'.format(
+                    self.base + i))
+
+    def _scalar_end(self, i):
+        while True:
+            match = _SCALAR.match(self.buf, i)
+            if match is None:
+                raise ValueError('expected a value at offset {}'.format(
+                    self.base + i))
+            if match.end() < len(self.buf) or not self._more():
+                return match.end()
+
+    def _container_end(self, i):
+        depth = 0
+        while True:
+            i = _BODY.match(self.buf, i).end()
+            char = self.buf[i:i + 1]
+            if char in (b'{', b'['):
+                depth += 1
+            elif char in (b'}', b']'):
+                depth -= 1
+                if depth == 0:
+                    return i + 1
+            elif self._more():
+                continue  # the buffer ran out, try again with more of it
+            else:
+                raise ValueError('unterminated value at offset {}'.format(
+                    self.base + i))
+            i += 1
+
+    def span(self):
+        """Skip the next value, returning where it starts and ends."""
+        char = self.ws()
+        start = self.pos
+        if char == b'"':
+            self.pos = self._string_end(start)
+        elif char in (b'{', b'['):
+            self.pos = self._container_end(start)
+        else:
+            self.pos = self._scalar_end(start)
+        return start, self.pos
+
+    def skip(self):
+        """Skip the next value without decoding it.
+
+        Unlike `span`, what has been skipped of an object or array is let go
+        of as the rest of it is read, so skipping one doesn't mean holding
+        all of it.
+
+        """
+        if self.ws() not in (b'{', b'['):
+            self.span()
+            return
+        depth = 0
+        while True:
+            self.pos = _BODY.match(self.buf, self.pos).end()
+            char = self.buf[self.pos:self.pos + 1]
+            if char in (b'{', b'['):
+                depth += 1
+            elif char in (b'}', b']'):
+                depth -= 1
+                if depth == 0:
+                    self.pos += 1
+                    return
+            else:
+                self.release()
+                if self._more():
+                    continue
+                raise ValueError('unterminated value at offset {}'.format(
+                    self.base + self.pos))
+            self.pos += 1
+
+    def raw(self):
+        """Return the offset and bytes of the next value."""
+        start, end = self.span()
+        return self.base + start, bytes(self.buf[start:end])
+
+    def value(self):
+        """Decode the next value."""
+        start, end = self.span()
+        return loads(self.buf[start:end])
+
+    def located(self):
+        """Decode the next value, along with its offsets in the document."""
+        start, end = self.span()
+        return self.base + start, self.base + end, loads(self.buf[start:end])
+
+    def key(self):
+        """Decode the next object key."""
+        if self.ws() != b'"':
+            raise ValueError('expected a key at offset {}'.format(
+                self.base + self.pos))
+        start, end = self.span()
+        raw = self.buf[start + 1:end - 1]
+        if b'\\' in raw:
+            return loads(self.buf[start:end])
+        return raw.decode('utf-8')
+
+    def members(self):
+        """Iterate over the keys of the next object.
+
+        The value of each key has to be read (or skipped) before moving on to
+        the next one.
+
+        """
+        self.expect(b'{')
+        if self.ws() == b'}':
+            self.pos += 1
+            return
+        while True:
+            self.release()
+            key = self.key()
+            self.expect(b':')
+            yield key
+            char = self.ws()
+            self.pos += 1
+            if char == b'}':
+                return
+            if char != b',':
+                raise ValueError('expected "," or "}}" at offset {}'.format(
+                    self.base + self.pos - 1))
+
+    def elements(self):
+        """Iterate over the next array, the same way as `members`."""
+        self.expect(b'[')
+        if self.ws() == b']':
+            self.pos += 1
+            return
+        idx = 0
+        while True:
+            self.release()
+            yield idx
+            idx += 1
+            char = self.ws()
+            self.pos += 1
+            if char == b']':
+                return
+            if char != b',':
+                raise ValueError('expected "," or "]" at offset {}'.format(
+                    self.base + self.pos - 1))
+
+
+@contextmanager
+def scan_file(path):
+    """Return a `Scanner` over the state file at `path`, as a context manager.
+
+    The file is memory-mapped when it can be, so that the decoder reads the
+    pages of the file itself rather than copies of them.
+
+    """
+    with open(path, 'rb') as state_file:
+        try:
+            mapped = mmap.mmap(state_file.fileno(), 0, access=mmap.ACCESS_READ)
+        except (EnvironmentError, ValueError):  # empty files, pipes...
+            mapped = None
+        if mapped is None:
+            yield Scanner(state_file)
+            return
+        try:
+            yield Scanner(data=mapped)
+        finally:
+            mapped.close()
+
+
+def _module_resources(scanner, wanted, offsets):
+    name, pending = None, []
+
+    def found(resource_key, start, end, resource):
+        if offsets is not None:
+            offsets.append([name, resource_key, start, end])
+        return name, resource_key, resource
+
+    for key in scanner.members():
+        if key == 'path':
+            name = scanner.value()[-1]
+            for located in pending:
+                yield found(*located)
+            pending = []
+        elif key == 'resources':
+            for resource_key in scanner.members():
+                if wanted is not None and not wanted(resource_key):
+                    scanner.skip()
+                elif name is None:
+                    # the path may have yet to come, in which case hold on to
+                    # what we've got
+                    pending.append((resource_key,) + scanner.located())
+                else:
+                    yield found(resource_key, *scanner.located())
+        else:
+            scanner.skip()
+
+
+def module_name(module):
+    """Return the name of a v4 module address: `b` for `module.a.module.b`.
+
+    Resources in the root module have no address, and are in `root`.
+
+    """
+    if not module:
+        return 'root'
+    return module.rsplit('module.', 1)[-1].split('[', 1)[0]
+
+
+def instance_key(block, index_key=None):
+    """Return the v3 resource key of an instance of a v4 resource block."""
+    key = u'{}.{}'.format(block['type'], block['name'])
+    if block.get('mode') == 'data':
+        key = u'data.' + key
+    if index_key is None:
+        return key
+    if isinstance(index_key, int):
+        return u'{}.{}'.format(key, index_key)
+    return u'{}[{}]'.format(key, json.dumps(index_key))  # for_each
+
+
+def instance_resource(resource_type, instance):
+    """Turn an instance in a v4 state into a resource the parsers can read."""
+    if 'attributes_flat' in instance:  # upgraded from a v3 state
+        attributes = FlatMap(instance['attributes_flat'])
+    else:
+        attributes = TypedAttributes(instance.get('attributes') or {})
+    return {'type': resource_type, 'primary': {
+        'id': attributes.get('id', ''),
+        'attributes': attributes,
+        'meta': {'schema_version': str(instance.get('schema_version', 0))},
+    }}
+
+
+def _block_resources(block, instances):
+    name = module_name(block.get('module'))
+    for instance in instances:
+        yield (name, instance_key(block, instance.get('index_key')),
+               instance_resource(block['type'], instance))
+
+
+def _block_instances(scanner, wanted, offsets):
+    block, instances = {}, []
+    for key in scanner.members():
+        if key != 'instances':
+            block[key] = scanner.value()
+        elif 'type' not in block or 'name' not in block:
+            # terraform writes them first, but we can't count on it
+            instances = scanner.value()
+        elif wanted is not None and not wanted(instance_key(block)):
+            scanner.skip()  # every instance of the block at once
+        else:
+            name = module_name(block.get('module'))
+            for _ in scanner.elements():
+                start, end, instance = scanner.located()
+                key = instance_key(block, instance.get('index_key'))
+                if offsets is not None:
+                    offsets.append([name, key, start, end, block['type']])
+                yield name, key, instance_resource(block['type'], instance)
+
+    if instances and (wanted is None or wanted(instance_key(block))):
+        for name, key, resource in _block_resources(block, instances):
+            if offsets is not None:
+                offsets.append([name, key, None, None, block['type']])
+            yield name, key, resource
+
+
+def iter_resources(scanner, wanted=None, offsets=None):
+    """Yield `(module_name, key, resource)` from a state, one at a time.
+
+    Both the `modules` of v3 states and the `resources` of v4 states (written
+    by terraform 0.12 and later) are read. Instances in v4 states are yielded
+    as v3 resources, with their typed attributes in `TypedAttributes`.
+
+    When given, `wanted` is called with each resource key, and the resources
+    it turns down are skipped over without being decoded at all. The module
+    name, key and offsets of every resource yielded are appended to the
+    `offsets` list, if there is one.
+
+    """
+    for key in scanner.members():
+        if key == 'modules':
+            for _ in scanner.elements():
+                for resource in _module_resources(scanner, wanted, offsets):
+                    yield resource
+        elif key == 'resources':
+            for _ in scanner.elements():
+                for resource in _block_instances(scanner, wanted, offsets):
+                    yield resource
+        else:
+            scanner.skip()
+
+
+def state_resources(state, wanted=None):
+    """Yield `(module_name, key, resource)` from a state that's been loaded."""
+    for module in state.get('modules', []):
+        name = module['path'][-1]
+        for key, resource in list(module['resources'].items()):
+            if wanted is None or wanted(key):
+                yield name, key, resource
+
+    for block in state.get('resources', []):
+        if wanted is None or wanted(instance_key(block)):
+            for resource in _block_resources(block, block['instances']):
+                yield resource
+
+
+def _scan_header(scanner):
+    header = {'serial': None, 'lineage': None}
+    if scanner.ws() != b'{':
+        scanner.skip()  # JSON all the same, or a ValueError
+        return header
+    found = set()
+    for key in scanner.members():
+        if key in header:
+            header[key] = scanner.value()
+            found.add(key)
+            if len(found) == len(header):
+                break
+        else:
+            scanner.skip()
+    return header
+
+
+def file_header(path, data=None):
+    """Return the `serial` and `lineage` of a state file, reading little.
+
+    Terraform writes both at the top of the file, so only the first few
+    kilobytes of a state file are read unless they turn out to be elsewhere,
+    in which case the members of the state are skipped over until both have
+    been found. They are read from `data` instead when the whole file has
+    been read.
+
+    """
+    if data is None:
+        with open(path, 'rb') as state_file:
+            head = state_file.read(4096)
+    else:
+        head = data[:4096]
+    header = {}
+    for key, value in _HEADER.findall(head):
+        header.setdefault(key.decode('utf-8'), loads(value))
+    if len(header) < 2:
+        if data is not None:
+            return _scan_header(Scanner(data=data))
+        with open(path, 'rb') as state_file:
+            return _scan_header(Scanner(state_file))
+    return header
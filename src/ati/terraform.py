@@ -18,13 +18,31 @@ Dynamic inventory for Terraform - finds all `.tfstate` files below the working
 directory and generates an inventory based on them.
 """
 
-from collections import defaultdict
-from functools import wraps
+from collections import defaultdict, deque
+from concurrent.futures import (
+    ProcessPoolExecutor, ThreadPoolExecutor, TimeoutError as FuturesTimeout)
+from functools import partial, wraps
+from multiprocessing import cpu_count
+from operator import itemgetter
+from string import Formatter
+import hashlib
 import json
 import os
 import re
-
-import sh
+import subprocess
+import tempfile
+import threading
+import time
+
+from ati import hostcache, offsets
+from ati.backends import (
+    current_workspace, detect_backend, list_workspaces, read_backend)
+from ati.discovery import walk
+from ati.errors import StatePullError
+from ati.flatmap import ExtractionPlan, FlatMap
+from ati.codec import dumps, loads
+from ati.mirror import Mirror
+from ati.stream import file_header, iter_resources, scan_file, state_resources
 
 # https://github.com/mantl/terraform.py/issues/74
 try:
@@ -34,40 +52,342 @@ except NameError:
     STRING_TYPES = [str]
 
 
-def tfstates(root=None):
+def tfstates(root=None, max_depth=None, index=False):
     root = root or os.getcwd()
-    for dirpath, _, filenames in os.walk(root):
+    for dirpath, _, filenames in walk(root, max_depth, index=index):
         for name in filenames:
             if os.path.splitext(name)[-1] == '.tfstate':
                 yield os.path.join(dirpath, name)
 
-def iter_states(root=None):
+def pull_state(dpath, timeout=None, workspace=None):
+    """Run `terraform state pull` in `dpath` and decode the state it prints.
+
+    The command gets `dpath` as its working directory and its stdout is read
+    straight from a pipe (no pty) into the JSON decoder. Anything terraform
+    prints before the state itself is skipped without copying the output.
+
+    Args:
+        dpath (str): Directory holding the `.terraform` dir.
+        timeout (float): Seconds to wait before killing terraform.
+        workspace (str): Workspace to pull instead of the selected one.
+
+    Raises:
+        StatePullError: When terraform fails or runs out of time.
+
+    """
+    env = None
+    if workspace:
+        env = dict(os.environ, TF_WORKSPACE=workspace)
+    with tempfile.TemporaryFile() as stderr:
+        proc = subprocess.Popen(['terraform', 'state', 'pull'], cwd=dpath,
+                                env=env, stdout=subprocess.PIPE, stderr=stderr)
+        expired = threading.Event()
+
+        def expire():
+            expired.set()
+            proc.kill()
+
+        timer = threading.Timer(timeout, expire)
+        if timeout is not None:
+            timer.start()
+        try:
+            output = proc.stdout.read()
+        finally:
+            proc.stdout.close()
+            proc.wait()
+            timer.cancel()
+
+        if expired.is_set():
+            raise StatePullError('terraform state pull in {} timed out after '
+                                 '{}s'.format(dpath, timeout))
+        if proc.returncode != 0:
+            stderr.seek(0)
+            raise StatePullError('terraform state pull in {} failed: {}'.format(
+                dpath, stderr.read().decode('utf-8', 'replace').strip()))
+
+    start_index = output.find(b'{')
+    if start_index < 0:
+        start_index = 0
+    try:
+        return loads(memoryview(output)[start_index:])
+    except ValueError:
+        # whatever terraform printed after the state
+        state, _ = json.JSONDecoder().raw_decode(
+            output[start_index:].decode('utf-8'))
+        return state
+
+
+def state_mirror(dpath, workspace=None):
+    """Return the `Mirror` of the state of `dpath`, or None if it is local."""
+    backend = detect_backend(dpath)
+    if backend and backend.get('type') == 'local':
+        return None
+    return Mirror(os.path.abspath(dpath),
+                  workspace or current_workspace(dpath), dumps(backend))
+
+
+def load_state(dpath, workspace=None, timeout=None, ttl=None):
+    """Read the state of `dpath`, natively if its backend allows it.
+
+    Falls back to `terraform state pull` for backends without a native reader.
+
+    With a `ttl`, remote states are mirrored locally and read from the
+    mirror: as is for `ttl` seconds after they were fetched, and once read
+    again past that, from a copy that is only rewritten if the state changed.
+
+    """
+    mirror = None if ttl is None else state_mirror(dpath, workspace)
+    if mirror is not None and mirror.fresh(ttl):
+        return mirror.path
+
+    state = read_backend(dpath, workspace)
+    if state is None:
+        state = pull_state(dpath, timeout=timeout, workspace=workspace)
+    if mirror is not None and isinstance(state, dict) and state:
+        return mirror.update(state)
+    return state
+
+
+def state_header(source):
+    """Return the `serial` and `lineage` of a state dict or state file."""
+    if type(source) not in STRING_TYPES:
+        return {'serial': source.get('serial'),
+                'lineage': source.get('lineage')}
+    return file_header(source)
+
+
+def state_identity(source):
+    """Return what tells a state dict or state file from its other versions.
+
+    State files are known by their size, mtime, serial and lineage, and
+    state dicts by their serial and lineage, or their whole content when they
+    lack either. Files that can't be read have no identity.
+
+    """
+    if type(source) in STRING_TYPES:
+        try:
+            return hostcache.state_identity(source)
+        except (EnvironmentError, ValueError):
+            return None
+    header = state_header(source)
+    if None in header.values():
+        return hashlib.sha1(dumps(source).encode('utf-8')).hexdigest()
+    return header
+
+
+def unique_lineage(sources):
+    """Drop states sharing their lineage with a newer one, keeping the order."""
+    sources = [(source, state_header(source)) for source in sources]
+    newest = {}
+    for idx, (_, header) in enumerate(sources):
+        lineage, serial = header['lineage'], header['serial'] or 0
+        if lineage is not None and serial >= newest.get(lineage, (-1, 0))[0]:
+            newest[lineage] = (serial, idx)
+
+    keep = set(idx for _, idx in newest.values())
+    for idx, (source, header) in enumerate(sources):
+        if header['lineage'] is None or idx in keep:
+            yield source
+
+
+def _loaded_in_time(targets, futures, source_timeout, stale):
+    end = time.time() + source_timeout
+    for target, future in zip(targets, futures):
+        try:
+            state = future.result(timeout=max(0, end - time.time()))
+        except FuturesTimeout:
+            mirror = None
+            if type(target) not in STRING_TYPES:
+                mirror = state_mirror(*target)
+            if mirror is None or mirror.meta is None:
+                state = future.result()  # nothing to make do with
+            else:
+                stale.append(target)
+                state = mirror.path
+        yield state
+
+
+def iter_states(root=None, jobs=None, timeout=None, all_workspaces=False,
+                hybrid=False, max_depth=None, index=False, ttl=None,
+                source_timeout=None, stale=None):
+    """Load the state of every directory below `root` with a `.terraform` dir.
+
+    States are loaded in a pool of `jobs` threads (the CPU count by default).
+    Pulls get their own working directory, so the process-wide cwd is never
+    touched. States are yielded in directory order, whatever order they load in.
+
+    In hybrid mode every directory is read from the cheapest source it has:
+    the `.tfstate` files of directories without a `.terraform` dir, and the
+    local file, a native backend reader or `terraform state pull`, in that
+    order, for the others. States read more than once through different
+    sources are only yielded once.
+
+    Args:
+        root (str): Root directory from which to search for terraform files.
+        jobs (int): Maximum number of states to load at once.
+        timeout (float): Seconds to wait for each pull.
+        all_workspaces (bool): Load every workspace the backend knows about,
+            instead of just the selected one.
+        hybrid (bool): Also read directories without a `.terraform` dir.
+        max_depth (int): How deep below `root` to look for states.
+        index (bool): Use the directory index to find states.
+        ttl (float): Mirror remote states, and read them from the mirror for
+            this many seconds after they were fetched.
+        source_timeout (float): Seconds to wait for states to load. States
+            that take longer are read from the mirror if it has them, and
+            left to load in the background.
+        stale (list): Where to add the directories, or `(directory,
+            workspace)` pairs, of the states read from the mirror past
+            `source_timeout`.
+
+    """
     root = root or os.getcwd()
-    curdir = os.getcwd()
-    for dpath, dnames, fnames in os.walk(root):
+    stages, paths = set(), []
+    for dpath, dnames, fnames in walk(root, max_depth, index=index):
         if '.terraform' in dnames:
-            try:
-                os.chdir(dpath)
-                output = sh.terraform("state", "pull").stdout.decode('utf-8')
-                start_index = output.find('{')
-                if start_index < 0:
-                    start_index = 0
-                yield json.loads(output[start_index:])
-            finally:
-                os.chdir(curdir)
-
-
-def iterresources(sources):
+            # .terraform/terraform.tfstate holds the backend config, no state
+            dnames.remove('.terraform')
+            stages.add(dpath)
+            paths.append(dpath)
+        elif hybrid:
+            paths.extend(os.path.join(dpath, name) for name in fnames
+                         if os.path.splitext(name)[-1] == '.tfstate')
+
+    def expand(path):
+        if path not in stages:
+            return [path]
+        if all_workspaces:
+            return [(path, workspace) for workspace in list_workspaces(path)]
+        return [(path, None)]
+
+    def load(target):
+        if type(target) in STRING_TYPES:
+            return target
+        return load_state(*target, timeout=timeout, ttl=ttl)
+
+    executor = ThreadPoolExecutor(max_workers=jobs or cpu_count())
+    try:
+        targets = [target for targets in executor.map(expand, sorted(paths))
+                   for target in targets]
+        if source_timeout is None:
+            states = executor.map(load, targets)
+        else:
+            states = _loaded_in_time(
+                targets, [executor.submit(load, target) for target in targets],
+                source_timeout, [] if stale is None else stale)
+        if hybrid:
+            states = unique_lineage(states)
+        for state in states:
+            yield state
+    finally:
+        # states that are late are not waited for
+        executor.shutdown(wait=source_timeout is None)
+
+
+# how many state files to read ahead, and how many bytes of them at most
+PREFETCH_DEPTH = 4
+PREFETCH_BYTES = 256 << 20
+# how many bytes of a file to read ahead at a time
+PREFETCH_CHUNK = 1 << 20
+
+
+def _read(path):
+    """Read `path` through, into the page cache but not into memory."""
+    buf = bytearray(PREFETCH_CHUNK)
+    try:
+        with open(path, 'rb') as state_file:
+            while state_file.readinto(buf):
+                pass
+    except EnvironmentError:
+        pass  # the parser has the same problem with it, and reports it
+
+
+def prefetch(sources, depth=PREFETCH_DEPTH, max_bytes=PREFETCH_BYTES):
+    """Yield `sources`, reading the state files among them ahead of time.
+
+    Up to `depth` sources past the one being parsed are looked at, and the
+    state files among them are read by a pool of threads as long as the
+    files read but not parsed yet add up to no more than `max_bytes`. Files
+    that are larger than that on their own are left to be read as they are
+    parsed. Sources keep their order.
+
+    Files are only read into the page cache, which the parser then maps them
+    from, so memory use stays that of streaming each one: what is read ahead
+    is not held by this process, and is let go of by the system first.
+
+    """
+    sources = iter(sources)
+    queue = deque()  # [source, size, future]
+    held = [0]
+
+    def start():
+        for entry in queue:
+            source, size, future = entry
+            if future is not None or size is None:
+                continue
+            if held[0] + size > max_bytes:
+                break  # wait for earlier files to be parsed, in order
+            entry[2] = executor.submit(_read, source)
+            held[0] += size
+
+    with ThreadPoolExecutor(max_workers=depth) as executor:
+        while True:
+            for source in sources:
+                size = None
+                if type(source) in STRING_TYPES:
+                    size = os.path.getsize(source)
+                    if size > max_bytes:
+                        size = None
+                queue.append([source, size, None])
+                if len(queue) > depth:
+                    break
+            if not queue:
+                return
+            start()
+
+            source, size, future = queue.popleft()
+            if future is not None:
+                future.result()
+                held[0] -= size
+            yield source
+
+
+def _of_types(types, key):
+    return key.split('.', 1)[0] in types
+
+
+def _file_resources(path, types, wanted):
+    if wanted is not None and os.path.getsize(path) >= offsets.MIN_SIZE:
+        for resource in offsets.indexed_resources(path, types, wanted):
+            yield resource
+    else:
+        with scan_file(path) as scanner:
+            for resource in iter_resources(scanner, wanted):
+                yield resource
+
+
+def iterresources(sources, types=None):
+    """Yield `(module_name, key, resource)` for every resource in `sources`.
+
+    Sources are state dicts or paths to state files. State files are
+    streamed, one resource at a time, instead of being loaded whole. When
+    `types` are given, the offsets of the resources found in large state
+    files are kept in an index, so later runs only read those.
+
+    Args:
+        sources (iterable): States to read resources from.
+        types (container): Only yield resources of these types. Resources of
+            other types are not even decoded.
+
+    """
+    wanted = None if types is None else partial(_of_types, types)
     for source in sources:
         if type(source) in STRING_TYPES:
-            with open(source, 'r') as json_file:
-                state = json.load(json_file)
+            resources = _file_resources(source, types, wanted)
         else:
-            state = source
-        for module in state['modules']:
-            name = module['path'][-1]
-            for key, resource in list(module['resources'].items()):
-                yield name, key, resource
+            resources = state_resources(source, wanted)
+        for resource in resources:
+            yield resource
 
 
 def get_stage_root(tf_dirname=None, root=None):
@@ -100,6 +420,7 @@ def get_stage_root(tf_dirname=None, root=None):
 
 ## READ RESOURCES
 PARSERS = {}
+PLANS = {}  # (resource type, schema version): ExtractionPlan
 
 
 def _clean_dc(dcname):
@@ -108,8 +429,13 @@ def _clean_dc(dcname):
     return re.sub('[^\w_\-]', '-', dcname)
 
 
-def iterhosts(resources, args):
-    '''yield host tuples of (name, attributes, groups)'''
+def iterhosts(resources, args, memo=None):
+    '''yield host tuples of (name, attributes, groups)
+
+    Resources whose parser returns None, having no host yet, are skipped.
+    Hosts of resources in `memo`, a `ResourceMemo`, are taken from there
+    instead of being parsed, and the others are added to it.
+    '''
     for module_name, key, resource in resources:
         resource_type, name = key.split('.', 1)
         try:
@@ -117,11 +443,182 @@ def iterhosts(resources, args):
         except KeyError:
             continue
 
-        yield parser(resource, module_name, args=args)
+        if memo is None:
+            host = _parse_host(parser, resource_type, resource, module_name,
+                               args)
+        else:
+            digest = memo.digest(module_name, resource_type, resource)
+            host = memo.get(digest)
+            if host is None:
+                host = _parse_host(parser, resource_type, resource,
+                                   module_name, args)
+                memo.put(digest, host)
+        if host is not None:
+            yield host
+
+
+def _parse_host(parser, resource_type, resource, module_name, args):
+    primary = resource.get('primary')
+    if primary and 'attributes' in primary:
+        plan_key = resource_type, primary.get('meta', {}).get(
+            'schema_version')
+        plan = PLANS.get(plan_key) or \
+            PLANS.setdefault(plan_key, ExtractionPlan())
+        attributes = primary['attributes']
+        if isinstance(attributes, FlatMap):  # read from a v4 state
+            attributes.plan = plan
+        else:
+            resource = dict(resource, primary=dict(
+                primary, attributes=FlatMap(attributes, plan=plan)))
+    return parser(resource, module_name, args=args)
+
+
+# how many resources of a large state each worker process parses at a time
+CHUNK_RESOURCES = 500
+
+
+def _memo_scope(source):
+    path = source if type(source) in STRING_TYPES else None
+    try:
+        header = file_header(path) if path else state_header(source)
+    except (EnvironmentError, ValueError):
+        return None
+    if header.get('lineage'):
+        return u'lineage:' + header['lineage']
+    if path:
+        return u'path:' + os.path.abspath(path)
+    return None
+
+
+def _source_hosts(source, cache, args):
+    resources = iterresources([source], types=PARSERS)
+    scope = None if cache is None else _memo_scope(source)
+    if scope is None:
+        return list(iterhosts(resources, args))
+    memo = cache.memo(scope)
+    hosts = list(iterhosts(resources, args, memo))
+    cache.save(memo)
+    return hosts
+
+
+def _chunk_hosts(path, chunk, args):
+    return list(iterhosts(offsets.read_resources(path, chunk), args))
+
+
+def _host_tasks(source, cache=None):
+    if type(source) in STRING_TYPES and \
+       os.path.getsize(source) >= offsets.MIN_SIZE:
+        entries = offsets.current_offsets(source, PARSERS)
+        if entries:
+            for start in range(0, len(entries), CHUNK_RESOURCES):
+                yield _chunk_hosts, (
+                    source, entries[start:start + CHUNK_RESOURCES])
+            return
+    yield _source_hosts, (source, cache)
+
+
+def pool_hosts(sources, args, workers, cache=None):
+    """Yield the hosts `iterhosts` would, parsed by a pool of processes.
+
+    Each state is parsed by one worker process, except large state files with
+    an up to date offset index, which are split in chunks of
+    `CHUNK_RESOURCES` resources. Hosts come out in the same order as they
+    would from `iterhosts`.
+
+    Args:
+        sources (iterable): States to read hosts from, as in `iterresources`,
+            or `CachedHosts`.
+        args (argparse.Namespace): Passed on to the parsers.
+        workers (int): How many processes to parse with.
+        cache (HostCache): Where to keep the hosts parsed.
+
+    """
+    stored = False
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        tasks = []  # (source, identity, futures)
+        for source in sources:
+            if isinstance(source, CachedHosts):
+                tasks.append((source, None, None))
+                continue
+            identity = None
+            if cache is not None and type(source) in STRING_TYPES:
+                identity = cache.identity(source)
+            tasks.append((source, identity, [
+                executor.submit(func, *(task_args + (args,)))
+                for func, task_args in _host_tasks(source, cache)]))
+
+        for source, identity, futures in tasks:
+            if futures is None:
+                hosts = source.hosts
+            else:
+                hosts = [host for future in futures
+                         for host in future.result()]
+                if identity is not None:
+                    cache.put(source, identity, hosts)
+                    stored = True
+            for host in hosts:
+                yield host
+        if stored:
+            cache.evict()
+
+
+class CachedHosts(object):
+    """A state file whose hosts are in the host cache, standing in for it."""
+
+    def __init__(self, path, hosts):
+        self.path = path
+        self.hosts = hosts
+
+
+def cached_sources(sources, cache):
+    """Yield `sources`, with the state files `cache` has hosts for replaced.
+
+    Those state files come out as `CachedHosts`, and aren't read any further.
+
+    """
+    for source in sources:
+        if type(source) in STRING_TYPES:
+            identity = cache.identity(source)
+            hosts = None if identity is None else cache.get(source, identity)
+            if hosts is not None:
+                source = CachedHosts(source, hosts)
+        yield source
+
+
+def cached_hosts(sources, args, cache):
+    """Yield the hosts of `sources`, keeping those of state files in `cache`.
+
+    Args:
+        sources (iterable): States to read hosts from, as in `iterresources`,
+            or `CachedHosts`.
+        args (argparse.Namespace): Passed on to the parsers.
+        cache (HostCache): Where to keep the hosts parsed.
+
+    """
+    stored = False
+    for source in sources:
+        if isinstance(source, CachedHosts):
+            hosts = source.hosts
+        else:
+            identity = None
+            if type(source) in STRING_TYPES:
+                # taken before parsing: if the file changes in the meantime,
+                # the hosts kept will simply be stale next time around
+                identity = cache.identity(source)
+            hosts = _source_hosts(source, cache, args)
+            if identity is not None:
+                cache.put(source, identity, hosts)
+                stored = True
+        for host in hosts:
+            yield host
+    if stored:
+        cache.evict()
 
 
 def parses(prefix):
     def inner(func):
+        if isinstance(func, dict):
+            func = calculate_mantl_vars(compile_mapping(func))
         PARSERS[prefix] = func
         return func
 
@@ -133,7 +630,10 @@ def calculate_mantl_vars(func):
 
     @wraps(func)
     def inner(*args, **kwargs):
-        name, attrs, groups = func(*args, **kwargs)
+        host = func(*args, **kwargs)
+        if host is None:  # no host in that resource
+            return None
+        name, attrs, groups = host
 
         # attrs
         if attrs.get('role', '') == 'control':
@@ -150,34 +650,28 @@ def calculate_mantl_vars(func):
     return inner
 
 
-def _parse_prefix(source, prefix, sep='.'):
-    for compkey, value in list(source.items()):
-        try:
-            curprefix, rest = compkey.split(sep, 1)
-        except ValueError:
-            continue
-
-        if curprefix != prefix or rest == '#':
-            continue
-
-        yield rest, value
+def _flatmap(source):
+    return source if isinstance(source, FlatMap) else FlatMap(source)
 
 
 def parse_attr_list(source, prefix, sep='.'):
-    attrs = defaultdict(dict)
-    for compkey, value in _parse_prefix(source, prefix, sep):
+    attrs = defaultdict(list)
+    indexes = []
+    for compkey, value in _flatmap(source).prefixed(prefix, sep):
         idx, key = compkey.split(sep, 1)
-        attrs[idx][key] = value
+        if idx not in attrs:
+            indexes.append(idx)
+        attrs[idx].append((key, value))
 
-    return list(attrs.values())
+    return [FlatMap(attrs[idx]) for idx in indexes]
 
 
 def parse_dict(source, prefix, sep='.'):
-    return dict(_parse_prefix(source, prefix, sep))
+    return FlatMap(_flatmap(source).prefixed(prefix, sep))
 
 
 def parse_list(source, prefix, sep='.'):
-    return [value for _, value in _parse_prefix(source, prefix, sep)]
+    return [value for _, value in _flatmap(source).prefixed(prefix, sep)]
 
 
 def parse_bool(string_form):
@@ -191,6 +685,133 @@ def parse_bool(string_form):
         raise ValueError('could not convert %r to a bool' % string_form)
 
 
+# PROVIDER MAPPINGS
+#
+# Most parsers copy attributes, coerce a few of them, and format groups out of
+# the result. A mapping says as much in a dict, which `parses` compiles into a
+# parser:
+#
+#     name      the source of the host name
+#     attrs     {attr: source}
+#     groups    templates formatted with the attrs, like 'do_size={size}', or
+#               (attr, template) pairs formatting a template for each item of
+#               a list, or each (key, value) of a dict
+#     mantl     optional, {'vars': attr holding the dc, role and python_bin
+#               vars, 'dc': attr holding the default dc (the module name when
+#               not given)}
+#
+# A source is the name of a required attribute, or a tuple whose first item
+# says what to do with the rest, see SOURCES.
+
+_OMIT = object()
+
+
+def _first(*keys):
+    def source(raw_attrs):
+        for key in keys:
+            if key in raw_attrs:
+                return raw_attrs[key]
+        raise KeyError(keys[0])
+    return source
+
+
+def _if(key, then, otherwise=None):
+    then = compile_source(then)
+    otherwise = (lambda raw_attrs: _OMIT) if otherwise is None else \
+        compile_source(otherwise)
+    return lambda raw_attrs: (then if key in raw_attrs else otherwise)(
+        raw_attrs)
+
+
+SOURCES = {
+    'const': lambda value: lambda raw_attrs: value,
+    'get': lambda key, default=None:
+        lambda raw_attrs: raw_attrs.get(key, default),
+    'first': _first,
+    'if': _if,
+    'bool': lambda key: lambda raw_attrs: parse_bool(raw_attrs[key]),
+    'json': lambda key, default='{}':
+        lambda raw_attrs: loads(raw_attrs.get(key, default)),
+    'list': lambda prefix, sep='.':
+        lambda raw_attrs: parse_list(raw_attrs, prefix, sep),
+    'dict': lambda prefix, sep='.':
+        lambda raw_attrs: parse_dict(raw_attrs, prefix, sep),
+    'attr_list': lambda prefix, sep='.':
+        lambda raw_attrs: parse_attr_list(raw_attrs, prefix, sep),
+}
+
+
+def compile_source(spec):
+    """Return a function reading `spec` from the attributes of a resource."""
+    if type(spec) in STRING_TYPES:
+        return itemgetter(spec)
+    return SOURCES[spec[0]](*spec[1:])
+
+
+def compile_group(spec):
+    """Return a function yielding the groups `spec` makes out of attrs."""
+    if type(spec) not in STRING_TYPES:
+        attr, template = spec
+        format_item = template.format
+
+        def groups(attrs):
+            items = attrs[attr]
+            if isinstance(items, dict):
+                return [format_item(*item) for item in items.items()]
+            return [format_item(item) for item in items]
+        return groups
+
+    # turn named fields into positional ones, looked up once per host
+    fields = []
+    positional = []
+    for literal, field, format_spec, conversion in Formatter().parse(spec):
+        positional.append(literal.replace('{', '{{').replace('}', '}}'))
+        if field is not None:
+            fields.append(field)
+            positional.append('{' + ('!' + conversion if conversion else '') +
+                              (':' + format_spec if format_spec else '') + '}')
+    format_group = ''.join(positional).format
+    return lambda attrs: [format_group(*[attrs[field] for field in fields])]
+
+
+def compile_mapping(mapping):
+    """Compile a provider mapping (see above) into a parser."""
+    name_source = compile_source(mapping['name'])
+    attr_sources = [(attr, compile_source(spec))
+                    for attr, spec in sorted(mapping['attrs'].items())]
+    group_sources = [compile_group(spec) for spec in mapping.get('groups', [])]
+    mantl = mapping.get('mantl')
+
+    def parser(resource, module_name, **kwargs):
+        raw_attrs = resource['primary']['attributes']
+        attrs = {}
+        for attr, source in attr_sources:
+            value = source(raw_attrs)
+            if value is not _OMIT:
+                attrs[attr] = value
+
+        if mantl is not None:
+            mantl_vars = attrs[mantl['vars']]
+            default_dc = attrs[mantl['dc']] if 'dc' in mantl else module_name
+            attrs.update({
+                'consul_dc': _clean_dc(mantl_vars.get('dc', default_dc)),
+                'role': mantl_vars.get('role', 'none'),
+                'ansible_python_interpreter': mantl_vars.get('python_bin',
+                                                             'python'),
+            })
+
+        groups = []
+        for source in group_sources:
+            groups.extend(source(attrs))
+        if mantl is not None:
+            groups.append('role=' + attrs['role'])
+            groups.append('dc=' + attrs['consul_dc'])
+
+        return name_source(raw_attrs), attrs, groups
+
+    return parser
+
+
 @parses('ddcloud_server')
 @calculate_mantl_vars
 def ddcloud_server(resource, module_name):
@@ -314,149 +935,94 @@ def triton_machine(resource, module_name, *args, **kwargs):
     return name, attrs, groups
 
 
-@parses('packet_device')
-@calculate_mantl_vars
-def packet_device(resource, tfvars=None):
-    raw_attrs = resource['primary']['attributes']
-    name = raw_attrs['id']
-    groups = []
-
-    attrs = {
-        'id': raw_attrs['id'],
-        'facility': raw_attrs['facility'],
-        'hostname': raw_attrs['hostname'],
-        'operating_system': raw_attrs['operating_system'],
-        'locked': parse_bool(raw_attrs['locked']),
-        'metadata': json.loads(raw_attrs.get('user_data', '{}')),
-        'plan': raw_attrs['plan'],
-        'project_id': raw_attrs['project_id'],
-        'state': raw_attrs['state'],
+packet_device = parses('packet_device')({
+    'name': 'id',
+    'attrs': {
+        'id': 'id',
+        'facility': 'facility',
+        'hostname': 'hostname',
+        'operating_system': 'operating_system',
+        'locked': ('bool', 'locked'),
+        'metadata': ('json', 'user_data'),
+        'plan': 'plan',
+        'project_id': 'project_id',
+        'state': 'state',
         # ansible
-        'ansible_ssh_host': raw_attrs['network.0.address'],
-        'ansible_ssh_user': 'root',  # it's always "root" on Packet
+        'ansible_ssh_host': 'network.0.address',
+        'ansible_ssh_user': ('const', 'root'),  # it's always "root" on Packet
         # generic
-        'ipv4_address': raw_attrs['network.0.address'],
-        'public_ipv4': raw_attrs['network.0.address'],
-        'ipv6_address': raw_attrs['network.1.address'],
-        'public_ipv6': raw_attrs['network.1.address'],
-        'private_ipv4': raw_attrs['network.2.address'],
-        'provider': 'packet',
-    }
-
-    # attrs specific to Mantl
-    attrs.update({
-        'consul_dc': _clean_dc(attrs['metadata'].get('dc', attrs['facility'])),
-        'role': attrs['metadata'].get('role', 'none'),
-        'ansible_python_interpreter': attrs['metadata']
-        .get('python_bin', 'python')
-    })
-
-    # add groups based on attrs
-    groups.append('packet_facility=' + attrs['facility'])
-    groups.append('packet_operating_system=' + attrs['operating_system'])
-    groups.append('packet_locked=%s' % attrs['locked'])
-    groups.append('packet_state=' + attrs['state'])
-    groups.append('packet_plan=' + attrs['plan'])
-    groups.extend('packet_metadata_%s=%s' % item
-                  for item in attrs['metadata'].items())
-
-    # groups specific to Mantl
-    groups.append('role=' + attrs['role'])
-    groups.append('dc=' + attrs['consul_dc'])
-
-    return name, attrs, groups
-
-
-@parses('digitalocean_droplet')
-@calculate_mantl_vars
-def digitalocean_host(resource, tfvars=None, **kwargs):
-    raw_attrs = resource['primary']['attributes']
-    name = raw_attrs['name']
-    groups = []
-
-    attrs = {
-        'id': raw_attrs['id'],
-        'image': raw_attrs['image'],
-        'ipv4_address': raw_attrs['ipv4_address'],
-        'locked': parse_bool(raw_attrs['locked']),
-        'metadata': json.loads(raw_attrs.get('user_data', '{}')),
-        'region': raw_attrs['region'],
-        'size': raw_attrs['size'],
-        'ssh_keys': parse_list(raw_attrs, 'ssh_keys'),
-        'status': raw_attrs['status'],
-        'tags': parse_list(raw_attrs, 'tags'),
+        'ipv4_address': 'network.0.address',
+        'public_ipv4': 'network.0.address',
+        'ipv6_address': 'network.1.address',
+        'public_ipv6': 'network.1.address',
+        'private_ipv4': 'network.2.address',
+        'provider': ('const', 'packet'),
+    },
+    'mantl': {'vars': 'metadata', 'dc': 'facility'},
+    'groups': [
+        'packet_facility={facility}',
+        'packet_operating_system={operating_system}',
+        'packet_locked={locked}',
+        'packet_state={state}',
+        'packet_plan={plan}',
+        ('metadata', 'packet_metadata_{}={}'),
+    ],
+})
+
+
+digitalocean_host = parses('digitalocean_droplet')({
+    'name': 'name',
+    'attrs': {
+        'id': 'id',
+        'image': 'image',
+        'ipv4_address': 'ipv4_address',
+        'locked': ('bool', 'locked'),
+        'metadata': ('json', 'user_data'),
+        'region': 'region',
+        'size': 'size',
+        'ssh_keys': ('list', 'ssh_keys'),
+        'status': 'status',
+        'tags': ('list', 'tags'),
         # ansible
-        'ansible_ssh_host': raw_attrs['ipv4_address'],
-        'ansible_ssh_user': 'root',  # it's always "root" on DO
+        'ansible_ssh_host': 'ipv4_address',
+        'ansible_ssh_user': ('const', 'root'),  # it's always "root" on DO
         # generic
-        'public_ipv4': raw_attrs['ipv4_address'],
-        'private_ipv4': raw_attrs.get('ipv4_address_private',
-                                      raw_attrs['ipv4_address']),
-        'provider': 'digitalocean',
-    }
-
-    # attrs specific to Mantl
-    attrs.update({
-        'consul_dc': _clean_dc(attrs['metadata'].get('dc', attrs['region'])),
-        'role': attrs['metadata'].get('role', 'none'),
-        'ansible_python_interpreter': attrs['metadata']
-        .get('python_bin', 'python')
-    })
-
-    # add groups based on attrs
-    groups.append('do_image=' + attrs['image'])
-    groups.append('do_locked=%s' % attrs['locked'])
-    groups.append('do_region=' + attrs['region'])
-    groups.append('do_size=' + attrs['size'])
-    groups.append('do_status=' + attrs['status'])
-    groups.extend('do_metadata_%s=%s' % item
-                  for item in attrs['metadata'].items())
-    groups.extend('do_tag=%s' % item
-                  for item in attrs['tags'])
-
-    # groups specific to Mantl
-    groups.append('role=' + attrs['role'])
-    groups.append('dc=' + attrs['consul_dc'])
-
-    return name, attrs, groups
-
-
-@parses('softlayer_virtualserver')
-@calculate_mantl_vars
-def softlayer_host(resource, module_name, **kwargs):
-    raw_attrs = resource['primary']['attributes']
-    name = raw_attrs['name']
-    groups = []
-
-    attrs = {
-        'id': raw_attrs['id'],
-        'image': raw_attrs['image'],
-        'ipv4_address': raw_attrs['ipv4_address'],
-        'metadata': json.loads(raw_attrs.get('user_data', '{}')),
-        'region': raw_attrs['region'],
-        'ram': raw_attrs['ram'],
-        'cpu': raw_attrs['cpu'],
-        'ssh_keys': parse_list(raw_attrs, 'ssh_keys'),
-        'public_ipv4': raw_attrs['ipv4_address'],
-        'private_ipv4': raw_attrs['ipv4_address_private'],
-        'ansible_ssh_host': raw_attrs['ipv4_address'],
-        'ansible_ssh_user': 'root',
-        'provider': 'softlayer',
-    }
-
-    # attrs specific to Mantl
-    attrs.update({
-        'consul_dc': _clean_dc(attrs['metadata'].get('dc', attrs['region'])),
-        'role': attrs['metadata'].get('role', 'none'),
-        'ansible_python_interpreter': attrs['metadata']
-        .get('python_bin', 'python')
-    })
-
-    # groups specific to Mantl
-    groups.append('role=' + attrs['role'])
-    groups.append('dc=' + attrs['consul_dc'])
-
-    return name, attrs, groups
+        'public_ipv4': 'ipv4_address',
+        'private_ipv4': ('first', 'ipv4_address_private', 'ipv4_address'),
+        'provider': ('const', 'digitalocean'),
+    },
+    'mantl': {'vars': 'metadata', 'dc': 'region'},
+    'groups': [
+        'do_image={image}',
+        'do_locked={locked}',
+        'do_region={region}',
+        'do_size={size}',
+        'do_status={status}',
+        ('metadata', 'do_metadata_{}={}'),
+        ('tags', 'do_tag={}'),
+    ],
+})
+
+
+softlayer_host = parses('softlayer_virtualserver')({
+    'name': 'name',
+    'attrs': {
+        'id': 'id',
+        'image': 'image',
+        'ipv4_address': 'ipv4_address',
+        'metadata': ('json', 'user_data'),
+        'region': 'region',
+        'ram': 'ram',
+        'cpu': 'cpu',
+        'ssh_keys': ('list', 'ssh_keys'),
+        'public_ipv4': 'ipv4_address',
+        'private_ipv4': 'ipv4_address_private',
+        'ansible_ssh_host': 'ipv4_address',
+        'ansible_ssh_user': ('const', 'root'),
+        'provider': ('const', 'softlayer'),
+    },
+    'mantl': {'vars': 'metadata', 'dc': 'region'},
+})
 
 
 @parses('openstack_compute_instance_v2')
@@ -617,6 +1183,80 @@ def aws_host(resource, module_name, **kwargs):
     return name, attrs, groups
 
 
+@parses('aws_spot_instance_request')
+@calculate_mantl_vars
+def aws_spot_host(resource, module_name, **kwargs):
+    """Parse the instance a spot request was fulfilled with, like `aws_host`.
+
+    Requests that are still open, or were never fulfilled, have no instance
+    yet, and no host.
+
+    """
+    args = kwargs.get('args')
+    name_key = getattr(args, 'aws_name_key', 'tags.Name')
+    ssh_host_key = getattr(args, 'aws_ssh_host_key', 'public_ip')
+    raw_attrs = resource['primary']['attributes']
+    if not raw_attrs.get('spot_instance_id') or \
+       not raw_attrs.get('private_ip'):
+        return None
+
+    public_ip = raw_attrs.get('public_ip', '')
+    attrs = {
+        'ami': raw_attrs['ami'],
+        'availability_zone': raw_attrs['availability_zone'],
+        'ebs_optimized': parse_bool(raw_attrs['ebs_optimized']),
+        'id': raw_attrs['id'],
+        'instance_type': raw_attrs['instance_type'],
+        'key_name': raw_attrs['key_name'],
+        'security_groups': parse_list(raw_attrs, 'security_groups'),
+        'spot_instance_id': raw_attrs['spot_instance_id'],
+        'spot_price': raw_attrs.get('spot_price', ''),
+        'spot_request_state': raw_attrs.get('spot_request_state', ''),
+        'subnet': parse_dict(raw_attrs, 'subnet', sep='_'),
+        'tags': parse_dict(raw_attrs, 'tags'),
+        'vpc_security_group_ids': parse_list(raw_attrs,
+                                             'vpc_security_group_ids'),
+        # ansible-specific
+        'ansible_ssh_host': raw_attrs.get(ssh_host_key) or
+        raw_attrs['private_ip'],
+        # generic
+        'public_ipv4': public_ip,
+        'private_ipv4': raw_attrs['private_ip'],
+        'provider': 'aws',
+    }
+    name = raw_attrs.get(name_key) or attrs['ansible_ssh_host']
+
+    # attrs specific to Ansible
+    if 'tags.sshUser' in raw_attrs:
+        attrs['ansible_ssh_user'] = raw_attrs['tags.sshUser']
+    if 'tags.sshPrivateIp' in raw_attrs:
+        attrs['ansible_ssh_host'] = raw_attrs['private_ip']
+    if 'tags.sshPrivateKey' in raw_attrs:
+        attrs['ansible_ssh_private_key_file'] = raw_attrs['tags.sshPrivateKey']
+
+    # attrs specific to Mantl
+    attrs.update({
+        'consul_dc': _clean_dc(attrs['tags'].get('dc', module_name)),
+        'role': attrs['tags'].get('role', 'none'),
+        'ansible_python_interpreter': attrs['tags'].get('python_bin',
+                                                        'python'),
+    })
+
+    groups = ['aws_ami=' + attrs['ami'],
+              'aws_az=' + attrs['availability_zone'],
+              'aws_key_name=' + attrs['key_name'],
+              'aws_spot_request_state=' + attrs['spot_request_state']]
+    groups.extend('aws_tag_%s=%s' % item for item in attrs['tags'].items())
+    groups.extend('aws_vpc_security_group=' + group
+                  for group in attrs['vpc_security_group_ids'])
+    groups.extend('aws_subnet_%s=%s' % subnet
+                  for subnet in attrs['subnet'].items())
+    groups.append('role=' + attrs['role'])
+    groups.append('dc=' + attrs['consul_dc'])
+
+    return name, attrs, groups
+
+
 @parses('google_compute_instance')
 @calculate_mantl_vars
 def gce_host(resource, module_name, **kwargs):
@@ -901,48 +1541,35 @@ def ucs_host(resource, module_name, **kwargs):
 
     return name, attrs, groups
 
-@parses('scaleway_server')
-@calculate_mantl_vars
-def scaleway_host(resource, tfvars=None):
-    raw_attrs = resource['primary']['attributes']
-    name = raw_attrs['name']
-    groups = []
-
-    attrs = {
-        'enable_ipv6': raw_attrs['enable_ipv6'],
-        'id': raw_attrs['id'],
-        'image': raw_attrs['image'],
-        'name': raw_attrs['name'],
-        'private_ip': raw_attrs['private_ip'],
-        'public_ip': raw_attrs['public_ip'],
-        'state': raw_attrs['state'],
-        'state_detail': raw_attrs['state_detail'],
-        'tags': parse_list(raw_attrs, 'tags'),
-        'type': raw_attrs['type'],
+scaleway_host = parses('scaleway_server')({
+    'name': 'name',
+    'attrs': {
+        'enable_ipv6': 'enable_ipv6',
+        'id': 'id',
+        'image': 'image',
+        'name': 'name',
+        'private_ip': 'private_ip',
+        'public_ip': 'public_ip',
+        'state': 'state',
+        'state_detail': 'state_detail',
+        'tags': ('list', 'tags'),
+        'type': 'type',
         # ansible
-        'ansible_ssh_host': raw_attrs['public_ip'],
-        'ansible_ssh_user': 'root',  # it's always "root" on DO
+        'ansible_ssh_host': ('if', 'tags.sshPrivateIp', 'private_ip',
+                             'public_ip'),
+        'ansible_ssh_user': ('get', 'tags.sshUser', 'root'),
         # generic
-        'public_ipv4': raw_attrs['public_ip'],
-        'private_ipv4': raw_attrs['private_ip'],
-        'provider': 'scaleway',
-    }
-
-
-    # attrs specific to Ansible
-    if 'tags.sshUser' in raw_attrs:
-        attrs['ansible_ssh_user'] = raw_attrs['tags.sshUser']
-    if 'tags.sshPrivateIp' in raw_attrs:
-        attrs['ansible_ssh_host'] = raw_attrs['private_ip']
-
-    # add groups based on attrs
-    groups.append('scaleway_image=' + attrs['image'])
-    groups.append('scaleway_type=' + attrs['type'])
-    groups.append('scaleway_state=' + attrs['state'])
-    groups.extend('scaleway_tag=%s' % item
-                  for item in attrs['tags'])
-
-    return name, attrs, groups
+        'public_ipv4': 'public_ip',
+        'private_ipv4': 'private_ip',
+        'provider': ('const', 'scaleway'),
+    },
+    'groups': [
+        'scaleway_image={image}',
+        'scaleway_type={type}',
+        'scaleway_state={state}',
+        ('tags', 'scaleway_tag={}'),
+    ],
+})
 
 
 # QUERY TYPES
@@ -1,8 +1,12 @@
 # -*- coding: utf-8 -*-
+import argparse
 import pytest
+import shutil
 import sys
 import os
 
+FIXTURES = os.path.join(os.path.dirname(__file__), 'fixtures')
+
 
 @pytest.yield_fixture(autouse=True)
 def pathify():
@@ -14,3 +18,45 @@ def pathify():
     sys.path.append(path)
     yield
     sys.path = [p for p in sys.path if p != path]
+
+
+def pytest_addoption(parser):
+    parser.addoption('--codec', choices=['orjson', 'json'], default='orjson',
+                     help='decode and encode JSON with orjson when it is '
+                          'installed, or always with the json module')
+
+
+def pytest_configure(config):
+    if config.getoption('codec') == 'json':
+        sys.modules['orjson'] = None  # as if it were not installed
+
+
+@pytest.fixture
+def fixture_path():
+    """Return the path of a file in `tests/fixtures`."""
+    return lambda name: os.path.join(FIXTURES, name)
+
+
+@pytest.fixture
+def cache(tmpdir, monkeypatch):
+    """Keep the ati cache in the temporary directory of the test."""
+    monkeypatch.setenv('ATI_CACHE_DIR', str(tmpdir.join('cache')))
+    return tmpdir.join('cache')
+
+
+@pytest.fixture
+def args():
+    """The arguments parsers are called with, by default."""
+    return argparse.Namespace(aws_name_key='tags.Name',
+                              aws_ssh_host_key='public_ip')
+
+
+@pytest.fixture
+def sources(tmpdir, cache, fixture_path):
+    """Copies of v3 and v4 state fixtures, along with a temporary cache."""
+    paths = []
+    for fixture in ['local_init.json', 'v4_state.json', 'remote_state.json']:
+        path = str(tmpdir.join(fixture))
+        shutil.copy(fixture_path(fixture), path)
+        paths.append(path)
+    return paths
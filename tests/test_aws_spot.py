@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+import pytest
+
+
+@pytest.fixture
+def aws_spot_host():
+    from ati.terraform import aws_spot_host
+    return aws_spot_host
+
+
+@pytest.fixture
+def aws_spot_resource():
+    return {
+        "type": "aws_spot_instance_request",
+        "primary": {
+            "id": "sir-3kbr5x2m", "attributes": {
+                "ami": "ami-fe100a96", "availability_zone": "us-east-1e",
+                "ebs_optimized": "false", "id": "sir-3kbr5x2m",
+                "instance_type": "m4.large", "key_name": "key-mi",
+                "private_ip": "10.0.152.192", "public_ip": "52.7.74.116",
+                "security_groups.#": "0", "spot_instance_id": "i-0d4f6f61",
+                "spot_price": "0.03", "spot_request_state": "active",
+                "subnet_id": "subnet-1155c03a", "tags.%": "3",
+                "tags.Name": "mi-worker-01", "tags.dc": "aws",
+                "tags.role": "worker", "vpc_security_group_ids.#": "1",
+                "vpc_security_group_ids.2601374546": "sg-9c360cf8",
+            },
+            "meta": {"schema_version": "1"},
+        },
+    }
+
+
+def test_name(aws_spot_resource, aws_spot_host):
+    name, _, _ = aws_spot_host(aws_spot_resource, 'module_name')
+    assert name == 'mi-worker-01'
+
+
+@pytest.mark.parametrize('attr,should', {
+    'ami': 'ami-fe100a96',
+    'availability_zone': 'us-east-1e',
+    'ebs_optimized': False,
+    'id': 'sir-3kbr5x2m',
+    'instance_type': 'm4.large',
+    'key_name': 'key-mi',
+    'security_groups': [],
+    'spot_instance_id': 'i-0d4f6f61',
+    'spot_price': '0.03',
+    'spot_request_state': 'active',
+    'subnet': {'id': 'subnet-1155c03a'},
+    'tags': {'Name': 'mi-worker-01', 'dc': 'aws', 'role': 'worker'},
+    'vpc_security_group_ids': ['sg-9c360cf8'],
+    # ansible
+    'ansible_ssh_host': '52.7.74.116',
+    # mi
+    'consul_dc': 'aws',
+    'role': 'worker',
+    'consul_is_server': False,
+    # generic
+    'private_ipv4': '10.0.152.192',
+    'public_ipv4': '52.7.74.116',
+    'provider': 'aws',
+}.items())
+def test_attrs(aws_spot_resource, aws_spot_host, attr, should):
+    _, attrs, _ = aws_spot_host(aws_spot_resource, 'module_name')
+    assert attr in attrs
+    assert attrs[attr] == should
+
+
+def test_ssh_tags(aws_spot_resource, aws_spot_host):
+    _, attrs, _ = aws_spot_host(aws_spot_resource, 'module_name')
+    assert 'ansible_ssh_user' not in attrs
+
+    aws_spot_resource['primary']['attributes'].update({
+        'tags.sshUser': 'centos', 'tags.sshPrivateIp': 'true'})
+    _, attrs, _ = aws_spot_host(aws_spot_resource, 'module_name')
+    assert attrs['ansible_ssh_user'] == 'centos'
+    assert attrs['ansible_ssh_host'] == '10.0.152.192'
+
+
+@pytest.mark.parametrize(
+    'group',
+    ['aws_ami=ami-fe100a96', 'aws_az=us-east-1e', 'aws_key_name=key-mi',
+     'aws_spot_request_state=active', 'aws_tag_role=worker',
+     'aws_tag_dc=aws', 'aws_tag_Name=mi-worker-01',
+     'aws_vpc_security_group=sg-9c360cf8', 'aws_subnet_id=subnet-1155c03a',
+     'role=worker', 'dc=aws'])
+def test_groups(aws_spot_resource, aws_spot_host, group):
+    _, _, groups = aws_spot_host(aws_spot_resource, 'module_name')
+    assert group in groups
+
+
+def test_args(aws_spot_resource, aws_spot_host):
+    import argparse
+    args = argparse.Namespace(aws_name_key='spot_instance_id',
+                              aws_ssh_host_key='private_ip')
+
+    name, attrs, _ = aws_spot_host(aws_spot_resource, 'module_name',
+                                   args=args)
+
+    assert name == 'i-0d4f6f61'
+    assert attrs['ansible_ssh_host'] == '10.0.152.192'
+
+
+@pytest.mark.parametrize('missing', [
+    ['spot_instance_id', 'public_ip', 'private_ip'],
+    ['public_ip', 'private_ip'],
+])
+def test_unfulfilled_skipped(aws_spot_resource, aws_spot_host, missing):
+    from ati.terraform import iterhosts
+    pending = {'type': 'aws_spot_instance_request', 'primary': {
+        'id': 'sir-pending', 'attributes': dict(
+            aws_spot_resource['primary']['attributes'], id='sir-pending',
+            spot_request_state='open')}}
+    for key in missing:
+        del pending['primary']['attributes'][key]
+    resources = [('root', 'aws_spot_instance_request.pending', pending),
+                 ('root', 'aws_spot_instance_request.w', aws_spot_resource)]
+
+    assert aws_spot_host(pending, 'module_name') is None
+    assert [name for name, _, _ in iterhosts(resources, None)] == \
+        ['mi-worker-01']
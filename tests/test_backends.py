@@ -0,0 +1,351 @@
+# -*- coding: utf-8 -*-
+import json
+import os
+import shutil
+import tempfile
+
+import boto3
+import pytest
+from hypothesis import given
+
+from tests.fixtures.hypothesis_state import remote_init_st
+
+try:
+    from moto import mock_aws
+except ImportError:  # moto < 5
+    from moto import mock_s3 as mock_aws
+
+
+@pytest.fixture
+def backends():
+    from ati import backends
+    return backends
+
+
+@pytest.fixture(autouse=True)
+def cache(cache, monkeypatch):
+    monkeypatch.delenv('TF_WORKSPACE', raising=False)
+    return cache
+
+
+def init(dpath, backend, workspace=None):
+    dotterraform = dpath.join('.terraform')
+    dotterraform.ensure(dir=True)
+    dotterraform.join('terraform.tfstate').write(json.dumps({
+        'version': 3, 'serial': 0, 'modules': [], 'backend': backend}))
+    if workspace:
+        dotterraform.join('environment').write(workspace)
+    return str(dpath)
+
+
+@given(remote_init_st())
+def test_backend_config(remote_init):
+    from ati.backends import backend_config
+    dpath = tempfile.mkdtemp()
+    try:
+        os.mkdir(os.path.join(dpath, '.terraform'))
+        with open(os.path.join(dpath, '.terraform', 'terraform.tfstate'),
+                  'w') as tfstate:
+            json.dump(remote_init, tfstate)
+
+        assert backend_config(dpath) == remote_init['backend']
+    finally:
+        shutil.rmtree(dpath)
+
+
+def test_backend_config_missing(backends, tmpdir):
+    assert backends.backend_config(str(tmpdir)) is None
+
+
+@pytest.mark.parametrize('environment,should', [
+    (None, 'default'), ('staging', 'staging'), ('\n', 'default')])
+def test_current_workspace(backends, tmpdir, environment, should):
+    dpath = init(tmpdir, {'type': 'local', 'config': {}}, environment)
+    assert backends.current_workspace(dpath) == should
+
+
+def test_current_workspace_env_var(backends, tmpdir, monkeypatch):
+    dpath = init(tmpdir, {'type': 'local', 'config': {}}, 'staging')
+    monkeypatch.setenv('TF_WORKSPACE', 'prod')
+    assert backends.current_workspace(dpath) == 'prod'
+
+
+@pytest.mark.parametrize('config,workspace,should', [
+    ({'key': 'a/terraform.tfstate'}, 'default', 'a/terraform.tfstate'),
+    ({'key': 'a/terraform.tfstate'}, 'dev', 'env:/dev/a/terraform.tfstate'),
+    ({'key': 'terraform.tfstate', 'workspace_key_prefix': 'ws'}, 'dev',
+     'ws/dev/terraform.tfstate'),
+])
+def test_s3_key(backends, config, workspace, should):
+    assert backends.s3_key(config, workspace) == should
+
+
+@pytest.fixture
+def s3(backends, monkeypatch):
+    monkeypatch.setenv('AWS_ACCESS_KEY_ID', 'testing')
+    monkeypatch.setenv('AWS_SECRET_ACCESS_KEY', 'testing')
+    monkeypatch.setattr(backends, '_S3_CLIENTS', {})
+    with mock_aws():
+        client = boto3.client('s3', region_name='us-east-1')
+        client.create_bucket(Bucket='test-terraform')
+        yield client
+
+
+S3_BACKEND = {'type': 's3', 'config': {
+    'bucket': 'test-terraform', 'key': 'test/terraform.tfstate',
+    'region': 'us-east-1', 'encrypt': 'true'}}
+
+
+def put_state(s3, key, serial):
+    s3.put_object(Bucket='test-terraform', Key=key,
+                  Body=json.dumps({'serial': serial, 'modules': []}))
+
+
+def test_s3_state(backends, s3, tmpdir):
+    put_state(s3, 'test/terraform.tfstate', 1)
+    put_state(s3, 'env:/dev/test/terraform.tfstate', 2)
+
+    assert backends.read_backend(init(tmpdir.mkdir('a'), S3_BACKEND)) == {
+        'serial': 1, 'modules': []}
+    assert backends.read_backend(
+        init(tmpdir.mkdir('b'), S3_BACKEND, 'dev')) == {
+            'serial': 2, 'modules': []}
+
+
+def test_s3_state_revalidates_with_etag(backends, s3, cache, tmpdir):
+    dpath = init(tmpdir, S3_BACKEND)
+    put_state(s3, 'test/terraform.tfstate', 1)
+    backends.read_backend(dpath)
+
+    # an unchanged state is served from the cache...
+    cached, = cache.join('s3').listdir('*.tfstate')
+    cached.write(json.dumps({'serial': 1, 'cached': True}))
+    assert backends.read_backend(dpath) == {'serial': 1, 'cached': True}
+
+    # ... until it changes
+    put_state(s3, 'test/terraform.tfstate', 2)
+    assert backends.read_backend(dpath) == {'serial': 2, 'modules': []}
+
+
+def test_s3_state_missing_falls_back(backends, s3, tmpdir):
+    assert backends.read_backend(init(tmpdir, S3_BACKEND)) is None
+
+
+def test_unknown_backend_falls_back(backends, tmpdir):
+    dpath = init(tmpdir, {'type': 'artifactory', 'config': {}})
+    assert backends.read_backend(dpath) is None
+
+
+def test_s3_workspaces(backends, s3):
+    put_state(s3, 'test/terraform.tfstate', 1)
+    for workspace in ['prod', 'dev']:
+        put_state(s3, 'env:/{}/test/terraform.tfstate'.format(workspace), 1)
+    put_state(s3, 'env:/dev/other/terraform.tfstate', 1)
+    put_state(s3, 'env:/deep/er/test/terraform.tfstate', 1)
+
+    workspaces = backends.s3_workspaces(S3_BACKEND['config'], None)
+
+    assert workspaces == ['default', 'dev', 'prod']
+
+
+def test_list_workspaces_without_lister(backends, tmpdir):
+    dpath = init(tmpdir, {'type': 'artifactory', 'config': {}}, 'dev')
+    assert backends.list_workspaces(dpath) == ['dev']
+
+
+def test_iter_states_all_workspaces(backends, s3, tmpdir):
+    from ati.terraform import iter_states
+    workspaces = ['ws{:03}'.format(i) for i in range(250)]
+    for serial, workspace in enumerate(workspaces):
+        put_state(s3, 'env:/{}/test/terraform.tfstate'.format(workspace),
+                  serial)
+    init(tmpdir.mkdir('stage'), S3_BACKEND)
+
+    states = list(iter_states(str(tmpdir), jobs=16, all_workspaces=True))
+
+    assert [state['serial'] for state in states] == list(range(250))
+
+
+class ConsulStandIn(object):
+    """Just enough of the consul KV API to serve states."""
+
+    def __init__(self):
+        self.kv, self.index = {}, 1
+        self.requests, self.connections = [], set()
+
+    def put(self, key, value):
+        self.index += 1
+        self.kv[key] = (value, self.index)
+
+    def handler(self):
+        try:
+            from http.server import BaseHTTPRequestHandler
+            from urllib.parse import parse_qs, unquote, urlsplit
+        except ImportError:  # python 2
+            from BaseHTTPServer import BaseHTTPRequestHandler
+            from urllib import unquote
+            from urlparse import parse_qs, urlsplit
+        consul = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                url = urlsplit(self.path)
+                key = unquote(url.path[len('/v1/kv/'):])
+                params = parse_qs(url.query, keep_blank_values=True)
+                consul.requests.append((key, sorted(params),
+                                        self.headers.get('X-Consul-Token')))
+                consul.connections.add(self.client_address)
+
+                matches = sorted(k for k in consul.kv if k.startswith(key))
+                if 'keys' in params:
+                    body = json.dumps(matches).encode('utf-8')
+                    index = max([consul.kv[k][1] for k in matches] or [1])
+                elif key in consul.kv:
+                    body, index = consul.kv[key]
+                else:
+                    body, index = b'', consul.index
+                self.send_response(200 if body else 404)
+                self.send_header('Content-Length', str(len(body)))
+                self.send_header('X-Consul-Index', str(index))
+                self.end_headers()
+                self.wfile.write(body)
+
+        return Handler
+
+
+@pytest.fixture
+def consul(backends, monkeypatch):
+    try:
+        from http.server import HTTPServer
+        from socketserver import ThreadingMixIn
+    except ImportError:  # python 2
+        from BaseHTTPServer import HTTPServer
+        from SocketServer import ThreadingMixIn
+    import threading
+
+    class Server(ThreadingMixIn, HTTPServer):
+        daemon_threads = True
+
+    standin = ConsulStandIn()
+    server = Server(('127.0.0.1', 0), standin.handler())
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    standin.address = '127.0.0.1:{}'.format(server.server_address[1])
+    monkeypatch.setattr(backends, 'CONSUL_POOL', backends.ConnectionPool())
+    yield standin
+    server.shutdown()
+    server.server_close()
+
+
+def consul_backend(consul):
+    return {'type': 'consul', 'config': {
+        'address': consul.address, 'path': 'tf/test', 'access_token': 'tkn'}}
+
+
+def test_consul_state(backends, consul, tmpdir):
+    consul.put('tf/test', b'{"serial": 1, "modules": []}')
+    consul.put('tf/test-env:dev', b'{"serial": 2, "modules": []}')
+
+    default = init(tmpdir.mkdir('a'), consul_backend(consul))
+    dev = init(tmpdir.mkdir('b'), consul_backend(consul), 'dev')
+
+    assert backends.read_backend(default) == {'serial': 1, 'modules': []}
+    assert backends.read_backend(dev) == {'serial': 2, 'modules': []}
+    assert all(token == 'tkn' for _, _, token in consul.requests)
+    assert len(consul.connections) == 1
+
+
+def test_consul_state_skips_unchanged(backends, consul, tmpdir):
+    consul.put('tf/test', b'{"serial": 1, "modules": []}')
+    dpath = init(tmpdir, consul_backend(consul))
+
+    backends.read_backend(dpath)
+    backends.read_backend(dpath)
+    assert [params for _, params, _ in consul.requests] == [
+        ['keys', 'separator'], ['raw'], ['keys', 'separator']]
+
+    consul.put('tf/test', b'{"serial": 2, "modules": []}')
+    assert backends.read_backend(dpath) == {'serial': 2, 'modules': []}
+
+
+def test_consul_state_gzip(backends, consul, tmpdir):
+    import gzip
+    import io
+    body = io.BytesIO()
+    with gzip.GzipFile(fileobj=body, mode='wb') as compressed:
+        compressed.write(b'{"serial": 1, "modules": []}')
+    consul.put('tf/test', body.getvalue())
+
+    dpath = init(tmpdir, consul_backend(consul))
+
+    assert backends.read_backend(dpath) == {'serial': 1, 'modules': []}
+
+
+def test_consul_state_missing_falls_back(backends, consul, tmpdir):
+    assert backends.read_backend(init(tmpdir, consul_backend(consul))) is None
+
+
+def test_consul_workspaces(backends, consul):
+    consul.put('tf/test', b'{}')
+    consul.put('tf/test-env:prod', b'{}')
+    consul.put('tf/test-env:dev', b'{}')
+    consul.put('tf/testing', b'{}')
+
+    config = consul_backend(consul)['config']
+
+    assert backends.consul_workspaces(config, None) == ['default', 'dev', 'prod']
+
+
+def local_stage(tmpdir, backend=None, workspace=None, states=()):
+    if backend:
+        dpath = init(tmpdir, backend, workspace)
+    else:
+        tmpdir.mkdir('.terraform')
+        dpath = str(tmpdir)
+    for state in states:
+        tmpdir.join(state).write('{}', ensure=True)
+    return dpath
+
+
+def test_detect_backend_local_without_backend_block(backends, tmpdir):
+    dpath = local_stage(tmpdir)
+    assert backends.detect_backend(dpath) == {'type': 'local', 'config': {}}
+
+
+@pytest.mark.parametrize('config,workspace,should', [
+    ({}, None, 'terraform.tfstate'),
+    ({}, 'dev', 'terraform.tfstate.d/dev/terraform.tfstate'),
+    ({'path': 'states/main.tfstate'}, None, 'states/main.tfstate'),
+    ({'path': 'states/main.tfstate', 'workspace_dir': 'ws'}, 'dev',
+     'ws/dev/terraform.tfstate'),
+])
+def test_local_state(backends, tmpdir, config, workspace, should):
+    dpath = local_stage(tmpdir, {'type': 'local', 'config': config},
+                        workspace, [should])
+
+    assert backends.read_backend(dpath) == str(tmpdir.join(should))
+
+
+def test_local_state_without_backend_block(backends, tmpdir):
+    dpath = local_stage(tmpdir, states=['terraform.tfstate'])
+    assert backends.read_backend(dpath) == str(tmpdir.join('terraform.tfstate'))
+
+
+def test_local_state_never_applied(backends, tmpdir):
+    assert backends.read_backend(local_stage(tmpdir)) == {}
+
+
+def test_local_workspaces(backends, tmpdir):
+    dpath = local_stage(tmpdir, states=[
+        'terraform.tfstate',
+        'terraform.tfstate.d/prod/terraform.tfstate',
+        'terraform.tfstate.d/dev/terraform.tfstate'])
+    tmpdir.join('terraform.tfstate.d').mkdir('empty')
+
+    assert backends.list_workspaces(dpath) == ['default', 'dev', 'prod']
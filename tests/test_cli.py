@@ -42,7 +42,39 @@ def test_terraform_state_root_env_var_sets_root(monkeypatch):
 
     args, _ = cli.get_args()
 
-    assert args.root == '/terraform'
+    assert args.root == ['/terraform']
+
+
+def test_several_roots(monkeypatch):
+    monkeypatch.setattr(sys, 'argv', ['bin/ati', '--list', '--root', '/a', '/b'])
+    args, _ = cli.get_args()
+
+    assert args.root == ['/a', '/b']
+
+
+def test_terraform_state_root_env_var_sets_several_roots(monkeypatch):
+    import os
+    monkeypatch.setattr(sys, 'argv', ['bin/ati', '--list'])
+    monkeypatch.setenv('TERRAFORM_STATE_ROOT', os.pathsep.join(['/a', '/b']))
+
+    args, _ = cli.get_args()
+
+    assert args.root == ['/a', '/b']
+
+
+def test_federated_hosts(monkeypatch):
+    import time
+
+    def root_hosts(root, args, states=None):
+        # the first root is the slowest
+        time.sleep(0.2 if root == '/a' else 0)
+        return iter([(root + '-host', {}, ['group'])])
+    monkeypatch.setattr(cli, 'root_hosts', root_hosts)
+
+    hosts = list(cli.federated_hosts(FakeNS(root=['/a', '/b'])))
+
+    assert hosts == [('/a-host', {'terraform_root': '/a'}, ['group']),
+                     ('/b-host', {'terraform_root': '/b'}, ['group'])]
 
 def test_aws_defaults(monkeypatch):
     args = ['bin/ati', '--list']
@@ -67,3 +99,31 @@ def test_version_output(monkeypatch, capsys):
     # This test is currently mostly a placeholder to demonstrate cli testing
     assert __version__ in out
     assert 'ati' in out
+
+
+def test_jobs_default(monkeypatch):
+    from multiprocessing import cpu_count
+    args = ['bin/ati', '--list']
+    monkeypatch.setattr(sys, 'argv', args)
+    args, _ = cli.get_args()
+
+    assert args.jobs == cpu_count()
+
+
+@pytest.mark.parametrize('argv,discovery', [
+    ([], 'terraform'),
+    (['--noterraform'], 'local'),
+    (['--discovery', 'hybrid'], 'hybrid'),
+])
+def test_discovery(monkeypatch, argv, discovery):
+    monkeypatch.setattr(sys, 'argv', ['bin/ati', '--list'] + argv)
+    args, _ = cli.get_args()
+
+    assert args.discovery == discovery
+
+
+def test_max_depth(monkeypatch):
+    monkeypatch.setattr(sys, 'argv', ['bin/ati', '--list', '--max-depth', '2'])
+    args, _ = cli.get_args()
+
+    assert args.max_depth == 2
@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+import json
+import math
+
+import pytest
+
+DOCUMENT = {'name': u'snow ☃', 'count': 3, 'on': True, 'none': None,
+            'list': [1.5, 'two', {'three': []}]}
+
+
+@pytest.fixture(params=['orjson', 'json'])
+def codec(request, monkeypatch):
+    from ati import codec
+    if request.param == 'json':
+        monkeypatch.setattr(codec, 'orjson', None)
+    elif codec.orjson is None:
+        pytest.skip('orjson is not installed')
+    return codec
+
+
+@pytest.mark.parametrize('wrap', [bytes, bytearray, memoryview, None])
+def test_loads(codec, wrap):
+    data = json.dumps(DOCUMENT)
+    if wrap is not None:
+        data = wrap(data.encode('utf-8'))
+
+    assert codec.loads(data) == DOCUMENT
+
+
+def test_loads_nan(codec):
+    assert math.isnan(codec.loads(b'[NaN]')[0])
+
+
+def test_loads_invalid(codec):
+    with pytest.raises(ValueError):
+        codec.loads(b'{"a": tru}')
+
+
+@pytest.mark.parametrize('indent', [None, 2, 4])
+def test_dumps(codec, indent):
+    assert json.loads(codec.dumps(DOCUMENT, indent=indent)) == DOCUMENT
+
+
+def test_dumps_non_str_keys(codec):
+    assert json.loads(codec.dumps({1: 'one'})) == {'1': 'one'}
+
+
+def test_scan_file(tmpdir):
+    from ati.stream import iter_resources, scan_file
+    empty = tmpdir.join('empty.tfstate')
+    empty.write('')
+    state = tmpdir.join('terraform.tfstate')
+    state.write(json.dumps({'modules': [
+        {'path': ['root'], 'resources': {'aws_instance.a': {}}}]}))
+
+    with scan_file(str(state)) as scanner:
+        assert list(iter_resources(scanner)) == [
+            ('root', 'aws_instance.a', {})]
+    with scan_file(str(empty)) as scanner:
+        with pytest.raises(ValueError):
+            list(iter_resources(scanner))
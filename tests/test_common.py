@@ -39,3 +39,113 @@ def test_publicly_routable(calculate_mantl_vars, routable):
         assert 'publicly_routable' in groups
     else:
         assert 'publicly_routable' not in groups
+
+
+ATTRIBUTES = {
+    'tags.%': '2', 'tags.Name': 'web', 'tags.a.b': 'dotted',
+    'network.#': '2', 'network.0.name': 'one', 'network.0.ip.%': '0',
+    'network.1.name': 'two', 'security_groups.#': '1',
+    'security_groups.0': 'default', 'private_ip': '10.0.0.1',
+    'private_dns': 'ip-10-0-0-1',
+}
+
+
+@pytest.mark.parametrize('flat', [False, True])
+def test_parse_helpers(flat):
+    from ati import terraform
+    source = terraform.FlatMap(ATTRIBUTES) if flat else dict(ATTRIBUTES)
+
+    assert terraform.parse_dict(source, 'tags') == {
+        'Name': 'web', 'a.b': 'dotted'}
+    assert terraform.parse_dict(source, 'private', sep='_') == {
+        'ip': '10.0.0.1', 'dns': 'ip-10-0-0-1'}
+    assert terraform.parse_list(source, 'security_groups') == ['default']
+    assert sorted(terraform.parse_attr_list(source, 'network'),
+                  key=lambda item: item['name']) == [
+        {'name': 'one', 'ip.%': '0'}, {'name': 'two'}]
+    assert terraform.parse_dict(source, 'missing') == {}
+
+
+def test_flatmap_splits_once(monkeypatch):
+    from ati.terraform import FlatMap, parse_dict, parse_list
+    source = FlatMap(ATTRIBUTES)
+    parse_dict(source, 'tags')
+
+    def no_splitting():
+        raise AssertionError('split the keys again')
+    monkeypatch.setattr(source, 'items', no_splitting)
+
+    assert parse_list(source, 'security_groups') == ['default']
+
+
+def test_extraction_plan():
+    from ati.terraform import ExtractionPlan, FlatMap, parse_dict, parse_list
+    plan = ExtractionPlan()
+    for _ in range(3):
+        source = FlatMap(ATTRIBUTES, plan=plan)
+        assert parse_dict(source, 'tags') == {'Name': 'web', 'a.b': 'dotted'}
+        assert parse_list(source, 'security_groups') == ['default']
+
+    prefixes, splits = plan.compiled['.']
+    assert prefixes == set(['tags', 'security_groups'])
+    assert splits['tags.Name'] == ('tags', 'Name')
+    assert splits['network.0.name'] is None
+
+    # prefixes the plan hasn't seen yet are still found
+    source = FlatMap(ATTRIBUTES, plan=plan)
+    assert parse_dict(source, 'private', sep='_') == {
+        'ip': '10.0.0.1', 'dns': 'ip-10-0-0-1'}
+    assert len(parse_list(source, 'network')) == 3
+    assert 'network' in plan.compiled['.'][0]
+
+
+def test_iterhosts_plans_per_schema_version(monkeypatch):
+    from ati import terraform
+    from ati.terraform import PARSERS, iterhosts, parse_dict
+
+    def parser(resource, module_name, **kwargs):
+        tags = parse_dict(resource['primary']['attributes'], 'tags')
+        return tags['Name'], tags, []
+    monkeypatch.setitem(PARSERS, 'test_plan_instance', parser)
+    monkeypatch.setattr('ati.terraform.PLANS', {})
+
+    resource = {'primary': {'attributes': ATTRIBUTES,
+                            'meta': {'schema_version': '1'}}}
+    resources = [('root', 'test_plan_instance.a', resource)] * 2
+
+    assert [name for name, _, _ in iterhosts(resources, None)] == [
+        'web', 'web']
+    assert list(terraform.PLANS) == [('test_plan_instance', '1')]
+
+
+def test_compile_mapping():
+    from ati.terraform import compile_mapping
+    parser = compile_mapping({
+        'name': ('first', 'hostname', 'id'),
+        'attrs': {
+            'id': 'id',
+            'up': ('bool', 'up'),
+            'size': ('get', 'size', 'small'),
+            'user': ('if', 'tags.user', 'tags.user'),
+            'tags': ('dict', 'tags'),
+            'disks': ('list', 'disks'),
+            'provider': ('const', 'test'),
+        },
+        'mantl': {'vars': 'tags'},
+        'groups': ['test_size={size}', 'test_up={up!s:>6}', '{{{id}}}',
+                   ('disks', 'test_disk={}'), ('tags', 'test_tag_{}={}')],
+    })
+    attributes = {'id': 'i-1', 'up': 'true', 'tags.%': '1', 'tags.dc': 'east',
+                  'disks.#': '1', 'disks.0': 'sda'}
+
+    name, attrs, groups = parser({'primary': {'attributes': attributes}},
+                                 'module_name')
+
+    assert name == 'i-1'
+    assert attrs == {
+        'id': 'i-1', 'up': True, 'size': 'small', 'tags': {'dc': 'east'},
+        'disks': ['sda'], 'provider': 'test', 'consul_dc': 'east',
+        'role': 'none', 'ansible_python_interpreter': 'python'}
+    assert groups == ['test_size=small', 'test_up=  True', '{i-1}',
+                      'test_disk=sda', 'test_tag_dc=east', 'role=none',
+                      'dc=east']
@@ -0,0 +1,191 @@
+# -*- coding: utf-8 -*-
+import json
+import os
+import stat
+import subprocess
+import sys
+import time
+
+import pytest
+
+
+@pytest.fixture
+def stage(tmpdir):
+    # a backend without a native reader, so that states are pulled
+    stage = tmpdir.mkdir('stage')
+    stage.mkdir('.terraform').join('terraform.tfstate').write(json.dumps(
+        {'backend': {'type': 'artifactory', 'config': {}}}))
+    return stage
+
+
+@pytest.fixture
+def state(tmpdir, fixture_path):
+    with open(fixture_path('v4_state.json')) as state_file:
+        state = json.load(state_file)
+    tmpdir.join('state.json').write(json.dumps(state))
+    return state
+
+
+@pytest.fixture
+def fake_terraform(tmpdir, monkeypatch, state):
+    """Put a `terraform` first on the PATH that pulls `state.json` slowly."""
+    bindir = tmpdir.mkdir('bin')
+    monkeypatch.setenv('PATH', '{}{}{}'.format(
+        bindir, os.pathsep, os.environ.get('PATH', '')))
+    terraform = bindir.join('terraform')
+    terraform.write('#!/bin/sh\nsleep $(cat {0}/delay)\ncat {0}/state.json\n'
+                    .format(tmpdir))
+    terraform.chmod(terraform.stat().mode | stat.S_IEXEC)
+
+    def delay(seconds):
+        tmpdir.join('delay').write(str(seconds))
+    delay(0)
+    return delay
+
+
+def get_args(monkeypatch, root, *argv):
+    from ati import cli
+    monkeypatch.setattr(sys, 'argv', ['bin/ati', '--root', str(root)] +
+                        list(argv))
+    args, _ = cli.get_args()
+    return args
+
+
+def test_serve_last_output_past_deadline(cache, stage, fake_terraform,
+                                         monkeypatch):
+    from ati import cli
+    args = get_args(monkeypatch, stage.dirpath(), '--list', '--deadline', '5')
+    fresh, stale = cli.serve(args)
+    assert not stale
+
+    fake_terraform(2)
+    args = get_args(monkeypatch, stage.dirpath(), '--list',
+                    '--deadline', '0.2')
+    started = time.time()
+
+    assert cli.serve(args) == (fresh, True)
+    assert time.time() - started < 1.5
+
+
+def test_serve_waits_without_last_output(cache, stage, fake_terraform,
+                                         monkeypatch):
+    from ati import cli
+    fake_terraform(0.5)
+    args = get_args(monkeypatch, stage.dirpath(), '--list',
+                    '--deadline', '0.1')
+
+    output, stale = cli.serve(args)
+
+    assert not stale
+    assert 'mi-control-01' in json.loads(output)['_meta']['hostvars']
+
+
+def test_late_sources_read_from_mirror(cache, stage, fake_terraform):
+    from ati.terraform import iter_states
+    root = str(stage.dirpath())
+    path, = iter_states(root, ttl=0)
+
+    fake_terraform(2)
+    stale = []
+    started = time.time()
+
+    assert list(iter_states(root, ttl=0, source_timeout=0.2,
+                            stale=stale)) == [path]
+    assert stale == [(str(stage), None)]
+    assert time.time() - started < 1.5
+
+
+@pytest.mark.parametrize('argv', [['--list'], ['--list', '--pretty']])
+def test_mark_stale(argv, monkeypatch):
+    from ati import cli
+    args = get_args(monkeypatch, '/', *argv)
+    output = cli.render([('a', {'x': 1}, ['g'])], args)
+
+    marked = json.loads(cli.mark_stale(output, args).decode('utf-8'))
+
+    assert marked['_meta']['stale'] is True
+    assert marked['g']['hosts'] == ['a']
+
+
+def test_mark_stale_leaves_hostfile(monkeypatch):
+    from ati import cli
+    args = get_args(monkeypatch, '/', '--hostfile')
+
+    assert cli.mark_stale(b'1.2.3.4\ta\n', args) == b'1.2.3.4\ta\n'
+
+
+def test_refresh_started_once(cache, monkeypatch):
+    from ati import cli
+    started = []
+    monkeypatch.setattr(subprocess, 'Popen',
+                        lambda command, **kwargs: started.append(command))
+    args = get_args(monkeypatch, '/', '--list', '--deadline', '1')
+
+    cli.refresh(args)
+    cli.refresh(args)
+
+    assert len(started) == 1
+    assert started[0][-4:] == ['--list', '--deadline', '1', '--refresh']
+
+
+@pytest.mark.parametrize('argv', [
+    ['--all-workspaces'], ['--max-depth', '2'], ['--discovery', 'local'],
+    ['--noterraform'], ['--noindex']])
+def test_last_output_kept_by_scope(cache, argv, monkeypatch):
+    from ati import cli
+    from ati.hostcache import OutputCache
+    output_cache = OutputCache()
+    args = get_args(monkeypatch, '/', '--list')
+    entry_path = output_cache.entry_path([], cli.output_options(args))
+    output_cache.put(entry_path, b'{}\n')
+    output_cache.remember(cli.output_options(args), entry_path)
+
+    scoped = get_args(monkeypatch, '/', '--list', *argv)
+
+    assert output_cache.last(cli.output_options(args)) == b'{}\n'
+    assert output_cache.last(cli.output_options(scoped)) is None
+
+
+def test_refresh_throttled_by_scope(cache, monkeypatch):
+    from ati import cli
+    started = []
+    monkeypatch.setattr(subprocess, 'Popen',
+                        lambda command, **kwargs: started.append(command))
+
+    cli.refresh(get_args(monkeypatch, '/', '--list', '--deadline', '1'))
+    cli.refresh(get_args(monkeypatch, '/', '--list', '--deadline', '1',
+                         '--all-workspaces'))
+
+    assert len(started) == 2
+
+
+def test_stale_served_then_refreshed(cache, stage, state, fake_terraform,
+                                     tmpdir):
+    from ati.hostcache import OutputCache
+    command = [sys.executable, '-c', 'from ati.cli import cli; cli()',
+               '--list', '--root', str(stage.dirpath())]
+    first = json.loads(subprocess.check_output(command + ['--deadline', '5']))
+
+    state['serial'] += 1
+    state['resources'][1]['instances'][0]['attributes']['tags'][
+        'Name'] = 'renamed'
+    tmpdir.join('state.json').write(json.dumps(state))
+    fake_terraform(3)
+    started = time.time()
+    second = json.loads(subprocess.check_output(
+        command + ['--deadline', '0.2']))
+
+    assert time.time() - started < 2.5
+    assert second['_meta'].pop('stale') is True
+    assert second == first
+
+    # the detached refresh leaves the fresh output for the next run
+    directory = OutputCache().directory
+    deadline = time.time() + 20
+    while time.time() < deadline:
+        time.sleep(0.2)
+        if any(b'renamed' in (cache.join('output', name).read('rb'))
+               for name in os.listdir(directory)):
+            break
+    else:
+        pytest.fail('the output was not refreshed')
@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+import os
+
+import pytest
+
+
+@pytest.fixture
+def walk():
+    from ati.discovery import walk
+    return walk
+
+
+@pytest.fixture
+def tree(tmpdir):
+    for path in [
+            'stage/main.tf',
+            'stage/.terraform/terraform.tfstate',
+            'stage/.terraform/plugins/linux_amd64/terraform-provider-aws',
+            'stage/.terraform/modules/vpc/terraform.tfstate',
+            'stage/nested/deeper/terraform.tfstate',
+            'other/terraform.tfstate',
+            '.git/objects/terraform.tfstate',
+            'app/node_modules/pkg/terraform.tfstate',
+            'live/.terragrunt-cache/x/terraform.tfstate',
+            'legacy/terraform.tfstate']:
+        tmpdir.join(path).ensure()
+    return tmpdir
+
+
+def walked(tmpdir, walk, **kwargs):
+    return [(os.path.relpath(dpath, str(tmpdir)), dnames, fnames)
+            for dpath, dnames, fnames in walk(str(tmpdir), **kwargs)]
+
+
+def test_walk_prunes(tree, walk):
+    assert walked(tree, walk) == [
+        ('.', ['.git', 'app', 'legacy', 'live', 'other', 'stage'], []),
+        ('app', ['node_modules'], []),
+        ('legacy', [], ['terraform.tfstate']),
+        ('live', ['.terragrunt-cache'], []),
+        ('other', [], ['terraform.tfstate']),
+        ('stage', ['.terraform', 'nested'], ['main.tf']),
+        ('stage/.terraform', ['modules', 'plugins'], ['terraform.tfstate']),
+        ('stage/nested', ['deeper'], []),
+        ('stage/nested/deeper', [], ['terraform.tfstate']),
+    ]
+
+
+def test_walk_respects_removed_dirnames(tree, walk):
+    seen = []
+    for dpath, dnames, _ in walk(str(tree)):
+        seen.append(os.path.relpath(dpath, str(tree)))
+        if 'stage' in dnames:
+            dnames.remove('stage')
+
+    assert not [path for path in seen if path.startswith('stage')]
+
+
+def test_walk_max_depth(tree, walk):
+    dpaths = [dpath for dpath, _, _ in walked(tree, walk, max_depth=1)]
+    assert dpaths == ['.', 'app', 'legacy', 'live', 'other', 'stage']
+
+
+def test_walk_atiignore(tree, walk):
+    tree.join('.atiignore').write('# old stuff\nlegacy/\n\n*/nested\n')
+
+    dpaths = [dpath for dpath, _, _ in walked(tree, walk)]
+
+    assert 'legacy' not in dpaths
+    assert 'stage/nested' not in dpaths
+    assert 'other' in dpaths
+
+
+def test_walk_does_not_follow_symlinks(tree, walk):
+    tree.join('link').mksymlinkto(tree.join('stage'))
+
+    top = walked(tree, walk)[0]
+
+    assert 'link' in top[1]
+    assert 'link' not in [dpath for dpath, _, _ in walked(tree, walk)]
+
+
+def test_tfstates(tree):
+    from ati.terraform import tfstates
+    found = [os.path.relpath(path, str(tree)) for path in tfstates(str(tree))]
+
+    assert found == ['legacy/terraform.tfstate', 'other/terraform.tfstate',
+                     'stage/.terraform/terraform.tfstate',
+                     'stage/nested/deeper/terraform.tfstate']
+
+
+@pytest.fixture
+def indexed(tree, monkeypatch, tmpdir_factory):
+    from ati import discovery
+    # not the `cache` fixture: a cache in the tree would be walked too
+    monkeypatch.setenv('ATI_CACHE_DIR', str(tmpdir_factory.mktemp('cache')))
+    # pretend nothing changed recently
+    for dpath, _, _ in discovery.walk(str(tree)):
+        os.utime(dpath, (1000000000, 1000000000))
+
+    listed = []
+
+    def listdir(dpath, prefix, patterns):
+        listed.append(os.path.relpath(dpath, str(tree)))
+        return real_listdir(dpath, prefix, patterns)
+    real_listdir = discovery._listdir
+    monkeypatch.setattr(discovery, '_listdir', listdir)
+    return listed
+
+
+def test_walk_index_reuses_listings(tree, walk, indexed):
+    first = walked(tree, walk, index=True)
+    del indexed[:]
+
+    assert walked(tree, walk, index=True) == first
+    assert indexed == []
+
+
+def test_walk_index_rescans_changed_dirs(tree, walk, indexed):
+    walked(tree, walk, index=True)
+    del indexed[:]
+
+    tree.join('other', 'new', 'terraform.tfstate').ensure()
+    dpaths = [dpath for dpath, _, _ in walked(tree, walk, index=True)]
+
+    assert 'other/new' in dpaths
+    assert indexed == ['other', 'other/new']
+
+
+def test_walk_without_index_always_lists(tree, walk, indexed):
+    walked(tree, walk, index=True)
+    del indexed[:]
+
+    walked(tree, walk)
+
+    assert len(indexed) == 9
+
+
+def test_walk_index_without_cache(tree, walk, indexed, monkeypatch):
+    # the cache root is a file, so no directory can be made below it
+    monkeypatch.setenv('ATI_CACHE_DIR', str(tree.join('legacy',
+                                                      'terraform.tfstate')))
+
+    assert walked(tree, walk, index=True) == walked(tree, walk)
+
+
+def test_walk_index_not_saved(tree, walk, indexed, monkeypatch):
+    from ati import discovery
+
+    def write_file(path, data):
+        raise IOError('read-only file system')
+    monkeypatch.setattr(discovery, 'write_file', write_file)
+
+    assert walked(tree, walk, index=True) == walked(tree, walk)
@@ -0,0 +1,207 @@
+# -*- coding: utf-8 -*-
+import argparse
+import json
+import os
+import sys
+
+import pytest
+
+
+@pytest.fixture
+def no_parsing(monkeypatch):
+    from ati import terraform
+
+    def parser(*args, **kwargs):
+        raise AssertionError('parsed a state again')
+    monkeypatch.setattr(terraform, 'PARSERS', dict.fromkeys(
+        terraform.PARSERS, parser))
+
+
+def cached(sources, args, max_bytes=1 << 20, read_ahead=False):
+    from ati.hostcache import HostCache
+    from ati.terraform import cached_hosts, cached_sources, prefetch
+    cache = HostCache(args, max_bytes)
+    sources = cached_sources(sources, cache)
+    if read_ahead:
+        sources = prefetch(sources)
+    return list(cached_hosts(sources, args, cache))
+
+
+def serial(sources, args):
+    from ati.terraform import PARSERS, iterhosts, iterresources
+    return list(iterhosts(iterresources(sources, types=PARSERS), args))
+
+
+def test_warm_hosts_not_parsed(sources, args, request):
+    expected = json.dumps(serial(sources, args))
+
+    assert json.dumps(cached(sources, args)) == expected
+    request.getfixturevalue('no_parsing')
+    assert json.dumps(cached(sources, args)) == expected
+
+
+def test_warm_pool_hosts_not_parsed(sources, args, request):
+    from ati.hostcache import HostCache
+    from ati.terraform import cached_sources, pool_hosts
+    expected = json.dumps(serial(sources, args))
+    cache = HostCache(args)
+
+    assert json.dumps(list(pool_hosts(sources, args, 2, cache))) == expected
+    request.getfixturevalue('no_parsing')
+    assert json.dumps(list(pool_hosts(
+        cached_sources(sources, cache), args, 2, cache))) == expected
+
+
+def test_prefetched_hosts_kept(sources, args, request, monkeypatch):
+    from ati import terraform
+    expected = json.dumps(serial(sources, args))
+
+    assert json.dumps(cached(sources, args, read_ahead=True)) == expected
+    request.getfixturevalue('no_parsing')
+    monkeypatch.setattr(terraform, '_read', None)  # nor read ahead
+    assert json.dumps(cached(sources, args, read_ahead=True)) == expected
+
+
+def test_changed_state_parsed_again(sources, args):
+    cached(sources, args)
+    with open(sources[1]) as state_file:
+        state = json.load(state_file)
+    state['serial'] += 1
+    del state['resources'][1]
+    with open(sources[1], 'w') as state_file:
+        json.dump(state, state_file)
+
+    assert [name for name, _, _ in cached(sources, args)] == \
+        [name for name, _, _ in serial(sources, args)]
+    assert 'mi-control-01' not in [
+        name for name, _, _ in cached(sources, args)]
+
+
+@pytest.fixture
+def parsed(monkeypatch):
+    from ati import terraform
+    parsed = []
+
+    def counting(parser):
+        def inner(resource, module_name, **kwargs):
+            parsed.append(resource['primary']['id'])
+            return parser(resource, module_name, **kwargs)
+        return inner
+    monkeypatch.setattr(terraform, 'PARSERS', dict(
+        (key, counting(parser))
+        for key, parser in terraform.PARSERS.items()))
+    return parsed
+
+
+def test_changed_resources_parsed_again(sources, args, parsed):
+    cached(sources, args)
+    del parsed[:]
+    with open(sources[1]) as state_file:
+        state = json.load(state_file)
+    state['serial'] += 1
+    state['resources'][1]['instances'][1]['attributes']['tags']['role'] = \
+        'worker'
+    with open(sources[1], 'w') as state_file:
+        json.dump(state, state_file)
+
+    hosts = cached(sources, args)
+
+    assert parsed == [state['resources'][1]['instances'][1]['attributes'][
+        'id']]
+    assert json.dumps(hosts) == json.dumps(serial(sources, args))
+
+
+def test_loaded_state_resources_kept(sources, args, parsed):
+    with open(sources[1]) as state_file:
+        state = json.load(state_file)
+    expected = json.dumps(serial([state], args))
+    del parsed[:]
+
+    assert json.dumps(cached([state], args)) == expected
+    assert len(parsed) == 4
+    assert json.dumps(cached([state], args)) == expected
+    assert len(parsed) == 4
+
+
+def test_memo_without_host(tmpdir):
+    from ati.hostcache import ResourceMemo
+    memo = ResourceMemo(str(tmpdir.join('memo.json')))
+    memo.put('a', None)
+    memo.put('b', ('name', {}, []))
+
+    assert memo.get('a') is None
+    assert memo.get('b') == ('name', {}, [])
+
+
+def test_args_are_part_of_the_key(sources, args):
+    other = argparse.Namespace(aws_name_key='id',
+                               aws_ssh_host_key='private_ip')
+    cold = cached(sources, args)
+
+    assert cached(sources, other) != cold
+    assert cached(sources, args) == cold
+
+
+def test_least_recently_used_evicted(sources, args):
+    from ati.hostcache import HostCache
+    cached(sources, args)
+    cache = HostCache(args)
+    entries = [cache.entry_path(path) for path in sources]
+    for name in os.listdir(cache.directory):  # resource memos
+        os.utime(os.path.join(cache.directory, name), (0, 0))
+    for age, entry in enumerate(entries, 1):
+        os.utime(entry, (age, age))
+    size = sum(os.path.getsize(entry) for entry in entries)
+
+    # reading an entry makes it the most recently used
+    cache.get(sources[0], cache.identity(sources[0]))
+    HostCache(args, size - 1).evict()
+
+    assert [os.path.exists(entry) for entry in entries] == [True, False, True]
+
+
+def test_evicted_once_per_run(sources, args, monkeypatch):
+    from ati import hostcache
+    from ati.terraform import pool_hosts
+    evictions = []
+    evict = hostcache.evict
+    monkeypatch.setattr(hostcache, 'evict', lambda *args: evictions.append(
+        evict(*args)))
+
+    cached(sources, args)
+    assert len(evictions) == 1
+    cached(sources, args)  # nothing written, nothing to evict
+    assert len(evictions) == 1
+    list(pool_hosts(sources, args, 2, hostcache.HostCache(args)))
+    assert len(evictions) == 2
+
+
+def test_unwritable_cache(sources, args, monkeypatch):
+    from ati import hostcache
+
+    def write_file(path, data):
+        raise IOError('read-only file system')
+    monkeypatch.setattr(hostcache, 'write_file', write_file)
+
+    assert cached(sources, args) == serial(sources, args)
+
+
+def test_no_cache_dir(sources, args, tmpdir, monkeypatch):
+    from ati import cli
+    # the cache root is a file, so no directory can be made below it
+    monkeypatch.setenv('ATI_CACHE_DIR', sources[0])
+    monkeypatch.setattr(sys, 'argv', ['bin/ati', '--list', '--root',
+                                      str(tmpdir)])
+    cli_args, _ = cli.get_args()
+
+    assert list(cli.root_hosts(str(tmpdir), cli_args, sources)) == \
+        serial(sources, args)
+
+
+def test_host_cache_arg(monkeypatch):
+    from ati import cli
+    monkeypatch.setattr(sys, 'argv',
+                        ['bin/ati', '--list', '--host-cache', '0'])
+    args, _ = cli.get_args()
+
+    assert args.host_cache == 0
@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+import json
+import os
+import sys
+
+import pytest
+
+
+@pytest.fixture
+def terraform(cache):
+    from ati import terraform
+    return terraform
+
+
+@pytest.fixture
+def stage(tmpdir):
+    # a backend without a native reader, so that states are pulled
+    stage = tmpdir.mkdir('stage')
+    stage.mkdir('.terraform').join('terraform.tfstate').write(json.dumps(
+        {'backend': {'type': 'artifactory', 'config': {}}}))
+    return str(stage)
+
+
+@pytest.fixture
+def pulled(terraform, monkeypatch):
+    pulled = []
+
+    def pull(dpath, **kwargs):
+        pulled.append(dpath)
+        return {'lineage': 'remote', 'serial': (len(pulled) - 1) // 2,
+                'modules': []}
+    monkeypatch.setattr(terraform, 'pull_state', pull)
+    return pulled
+
+
+def test_fresh_mirror_used(terraform, stage, pulled):
+    path = terraform.load_state(stage, ttl=60)
+
+    assert terraform.load_state(stage, ttl=60) == path
+    assert pulled == [stage]
+    with open(path) as state_file:
+        assert json.load(state_file) == {'lineage': 'remote', 'serial': 0,
+                                         'modules': []}
+
+
+def test_stale_mirror_rewritten_when_changed(terraform, stage, pulled):
+    path = terraform.load_state(stage, ttl=0)
+    os.utime(path, (0, 0))
+
+    # same serial: the copy is left alone
+    assert terraform.load_state(stage, ttl=0) == path
+    assert os.path.getmtime(path) == 0
+
+    # a new serial: the copy is replaced
+    assert terraform.load_state(stage, ttl=0) == path
+    assert os.path.getmtime(path) != 0
+    assert pulled == [stage] * 3
+    with open(path) as state_file:
+        assert json.load(state_file)['serial'] == 1
+
+
+def test_workspaces_mirrored_apart(terraform, stage, pulled):
+    assert terraform.load_state(stage, 'dev', ttl=60) != \
+        terraform.load_state(stage, 'prod', ttl=60)
+    assert len(pulled) == 2
+
+
+def test_local_states_not_mirrored(terraform, tmpdir):
+    tmpdir.join('.terraform').ensure(dir=True)
+    tmpdir.join('terraform.tfstate').write('{}')
+
+    assert terraform.load_state(str(tmpdir), ttl=60) == \
+        str(tmpdir.join('terraform.tfstate'))
+
+
+def test_no_ttl_no_mirror(terraform, stage, pulled):
+    assert terraform.load_state(stage) == {'lineage': 'remote', 'serial': 0,
+                                           'modules': []}
+
+
+def test_mirror_ttl_arg(monkeypatch):
+    from ati import cli
+    monkeypatch.setattr(sys, 'argv', ['bin/ati', '--list',
+                                      '--mirror-ttl', '300'])
+    args, _ = cli.get_args()
+
+    assert args.mirror_ttl == 300
@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+import json
+import os
+
+import pytest
+
+STATE = {'version': 3, 'serial': 4, 'lineage': 'abc', 'modules': [{
+    'path': ['root'],
+    'resources': {
+        'aws_iam_policy.p': {'type': 'aws_iam_policy',
+                             'primary': {'attributes': {'policy': '{}'}}},
+        'aws_instance.web': {'type': 'aws_instance',
+                             'primary': {'attributes': {'id': 'i-1'}}},
+    },
+}, {
+    'resources': {
+        'aws_instance.db': {'type': 'aws_instance',
+                            'primary': {'attributes': {'id': 'i-2'}}},
+    },
+    'path': ['root', 'db'],
+}]}
+
+EXPECTED = [
+    ('root', 'aws_instance.web', STATE['modules'][0]['resources'][
+        'aws_instance.web']),
+    ('db', 'aws_instance.db', STATE['modules'][1]['resources'][
+        'aws_instance.db']),
+]
+
+
+@pytest.fixture
+def offsets(cache, monkeypatch):
+    from ati import offsets
+    monkeypatch.setattr(offsets, 'MIN_SIZE', 0)
+    return offsets
+
+
+@pytest.fixture
+def state_path(tmpdir):
+    path = tmpdir.join('terraform.tfstate')
+    path.write(json.dumps(STATE, indent=2))
+    return str(path)
+
+
+def resources(state_path):
+    from ati.terraform import PARSERS, iterresources
+    return list(iterresources([state_path], types=PARSERS))
+
+
+def test_builds_index(offsets, state_path):
+    from ati.terraform import PARSERS
+
+    assert resources(state_path) == EXPECTED
+
+    identity = offsets.file_identity(state_path)
+    indexed = offsets.read_index(state_path, PARSERS, identity)
+    assert [entry[:2] for entry in indexed] == [
+        ['root', 'aws_instance.web'], ['db', 'aws_instance.db']]
+
+
+def test_reuses_index(offsets, state_path, monkeypatch):
+    resources(state_path)
+
+    def no_scanning(*args, **kwargs):
+        raise AssertionError('scanned the state file again')
+    monkeypatch.setattr(offsets, 'iter_resources', no_scanning)
+
+    assert resources(state_path) == EXPECTED
+
+
+def test_stale_index(offsets, state_path):
+    resources(state_path)
+
+    state = json.loads(json.dumps(STATE))
+    state['serial'] = 5
+    del state['modules'][1]
+    with open(state_path, 'w') as state_file:
+        json.dump(state, state_file)
+    os.utime(state_path, (0, 0))
+
+    assert resources(state_path) == EXPECTED[:1]
+
+
+def test_small_files_not_indexed(offsets, state_path, monkeypatch):
+    monkeypatch.setattr(offsets, 'MIN_SIZE', 1 << 30)
+
+    assert resources(state_path) == EXPECTED
+    assert os.listdir(offsets.cache_dir('offsets')) == []
@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+import json
+import shutil
+import sys
+
+import pytest
+
+
+@pytest.fixture
+def root(tmpdir, cache, fixture_path):
+    root = tmpdir.mkdir('root')
+    for fixture in ['local_init.json', 'v4_state.json']:
+        shutil.copy(fixture_path(fixture),
+                    str(root.join(fixture[:-len('.json')] + '.tfstate')))
+    return root
+
+
+@pytest.fixture
+def run(root, monkeypatch, capsys):
+    from ati import cli
+
+    def run(*argv):
+        monkeypatch.setattr(sys, 'argv', ['bin/ati', '--discovery', 'local',
+                                          '--root', str(root)] + list(argv))
+        with pytest.raises(SystemExit):
+            cli.cli()
+        out, _ = capsys.readouterr()
+        return out
+    return run
+
+
+@pytest.fixture
+def no_rendering(monkeypatch):
+    from ati import cli
+
+    def render(*args):
+        raise AssertionError('rendered the output again')
+    monkeypatch.setattr(cli, 'render', render)
+
+
+def test_output_kept(run, request):
+    listed, hostfile = run('--list'), run('--hostfile')
+    uncached = run('--list', '--output-cache', '0')
+    request.getfixturevalue('no_rendering')
+
+    assert run('--list') == listed
+    assert run('--hostfile') == hostfile
+    assert json.loads(listed) == json.loads(uncached)
+    assert 'mi-control-01' in hostfile
+
+
+def test_output_args_are_part_of_the_key(run):
+    compact = run('--list')
+
+    assert run('--list', '--pretty') != compact
+    assert run('--list', '--nometa') != compact
+    assert run('--list') == compact
+
+
+def test_changed_state_rendered_again(run, root):
+    before = json.loads(run('--list'))
+    with open(str(root.join('v4_state.tfstate'))) as state_file:
+        state = json.load(state_file)
+    state['serial'] += 1
+    del state['resources'][1]
+    with open(str(root.join('v4_state.tfstate')), 'w') as state_file:
+        json.dump(state, state_file)
+
+    after = json.loads(run('--list'))
+
+    assert 'mi-control-01' in before['_meta']['hostvars']
+    assert 'mi-control-01' not in after['_meta']['hostvars']
+
+
+def test_no_cache_dir(run, root, monkeypatch):
+    uncached = run('--list', '--output-cache', '0')
+    # the cache root is a file, so no directory can be made below it
+    monkeypatch.setenv('ATI_CACHE_DIR', str(root.join('local_init.tfstate')))
+
+    assert json.loads(run('--list')) == json.loads(uncached)
+
+
+def test_unwritable_cache(run, monkeypatch):
+    from ati import hostcache
+    uncached = run('--list', '--output-cache', '0')
+
+    def write_file(path, data):
+        raise IOError('read-only file system')
+    monkeypatch.setattr(hostcache, 'write_file', write_file)
+
+    assert json.loads(run('--list')) == json.loads(uncached)
+    assert json.loads(run('--list')) == json.loads(uncached)
+
+
+def test_state_identity():
+    from ati.terraform import state_identity
+
+    assert state_identity({'serial': 1, 'lineage': 'a', 'modules': []}) == \
+        {'serial': 1, 'lineage': 'a'}
+    assert state_identity({'modules': [1]}) != state_identity({'modules': []})
+    assert state_identity('/does/not/exist') is None
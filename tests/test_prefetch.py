@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+import json
+import sys
+import threading
+
+import pytest
+
+
+@pytest.fixture
+def terraform():
+    from ati import terraform
+    return terraform
+
+
+@pytest.fixture
+def files(tmpdir):
+    paths = []
+    for idx in range(6):
+        state = {'version': 3, 'serial': idx, 'modules': [{
+            'path': ['root'], 'resources': {'aws_instance.i{}'.format(idx): {
+                'type': 'aws_instance', 'padding': 'x' * 40}}}]}
+        path = tmpdir.join('{}.tfstate'.format(idx))
+        path.write(json.dumps(state))
+        paths.append(str(path))
+    return paths
+
+
+@pytest.fixture
+def reads(terraform, monkeypatch):
+    seen = []
+    lock = threading.Lock()
+    read = terraform._read
+
+    def recording_read(path):
+        with lock:
+            seen.append(path)
+        return read(path)
+    monkeypatch.setattr(terraform, '_read', recording_read)
+    return seen
+
+
+def test_prefetch_keeps_order(terraform, files, reads):
+    state = {'modules': []}
+    sources = files[:3] + [state] + files[3:]
+
+    prefetched = list(terraform.prefetch(sources, depth=2))
+
+    assert prefetched == sources
+    assert sorted(reads) == sorted(files)
+
+
+def test_prefetch_bounds(terraform, files, reads):
+    size = len(open(files[0], 'rb').read())
+
+    for idx, source in enumerate(terraform.prefetch(
+            files, depth=4, max_bytes=int(size * 2.5))):
+        # the one being parsed, and one more that fits in the ceiling
+        assert len(reads) <= idx + 2
+
+
+def test_prefetch_leaves_large_files(terraform, files, reads):
+    prefetched = list(terraform.prefetch(files, max_bytes=10))
+
+    assert prefetched == files
+    assert reads == []
+
+
+def test_prefetched_files_mapped(terraform, files, monkeypatch):
+    # what is read ahead is left in the page cache, to be mapped from there
+    mapped = []
+    scan_file = terraform.scan_file
+
+    def recording_scan_file(path):
+        mapped.append(path)
+        return scan_file(path)
+    monkeypatch.setattr(terraform, 'scan_file', recording_scan_file)
+
+    list(terraform.iterresources(terraform.prefetch(files)))
+
+    assert mapped == files
+
+
+def test_prefetch_read_errors_left_to_parser(terraform, tmpdir):
+    missing = str(tmpdir.join('missing.tfstate'))
+    terraform._read(missing)
+
+    with pytest.raises(EnvironmentError):
+        list(terraform.iterresources([missing]))
+
+
+def test_iterresources_prefetched(terraform, files, cache, monkeypatch):
+    from ati import offsets
+    expected = list(terraform.iterresources(files))
+
+    assert list(terraform.iterresources(terraform.prefetch(files))) == \
+        expected
+
+    # large files are indexed from what was read, then read from the index
+    monkeypatch.setattr(offsets, 'MIN_SIZE', 0)
+    assert list(terraform.iterresources(
+        terraform.prefetch(files), types=['aws_instance'])) == expected
+    monkeypatch.setattr(offsets, 'iter_resources', None)
+    assert list(terraform.iterresources(
+        terraform.prefetch(files), types=['aws_instance'])) == expected
+
+
+def test_prefetch_args(monkeypatch):
+    from ati import cli
+    monkeypatch.setattr(sys, 'argv', ['bin/ati', '--list', '--prefetch', '0',
+                                      '--prefetch-memory', '16'])
+    args, _ = cli.get_args()
+
+    assert (args.prefetch, args.prefetch_memory) == (0, 16)
@@ -0,0 +1,162 @@
+# -*- coding: utf-8 -*-
+import json
+import os
+import stat
+import time
+
+import pytest
+
+
+@pytest.fixture
+def terraform():
+    from ati import terraform
+    return terraform
+
+
+@pytest.fixture
+def fake_terraform(tmpdir, monkeypatch):
+    """Put a `terraform` running the given shell snippet first on the PATH."""
+    bindir = tmpdir.mkdir('bin')
+    monkeypatch.setenv('PATH', '{}{}{}'.format(
+        bindir, os.pathsep, os.environ.get('PATH', '')))
+
+    def install(script):
+        terraform = bindir.join('terraform')
+        terraform.write('#!/bin/sh\n' + script)
+        terraform.chmod(terraform.stat().mode | stat.S_IEXEC)
+
+    return install
+
+
+@pytest.fixture
+def stages(tmpdir):
+    # a backend without a native reader, so that states are pulled
+    backend = json.dumps({'backend': {'type': 'artifactory', 'config': {}}})
+    for stage in ['a', 'b', 'c', 'd']:
+        tmpdir.mkdir(stage).mkdir('.terraform').join(
+            'terraform.tfstate').write(backend)
+    tmpdir.mkdir('nothing')
+    return tmpdir
+
+
+def test_iter_states_yields_in_directory_order(terraform, stages, monkeypatch):
+    def pull(dpath, **kwargs):
+        # the first stages finish last
+        time.sleep({'a': 0.3, 'b': 0.2, 'c': 0.1, 'd': 0}[dpath[-1]])
+        return {'stage': os.path.basename(dpath)}
+    monkeypatch.setattr(terraform, 'pull_state', pull)
+
+    states = list(terraform.iter_states(str(stages), jobs=4))
+
+    assert [state['stage'] for state in states] == ['a', 'b', 'c', 'd']
+
+
+def test_iter_states_leaves_cwd_alone(terraform, stages, monkeypatch):
+    cwd = os.getcwd()
+    seen = []
+
+    def pull(dpath, **kwargs):
+        seen.append(os.getcwd())
+        return {}
+    monkeypatch.setattr(terraform, 'pull_state', pull)
+
+    list(terraform.iter_states(str(stages), jobs=2))
+
+    assert seen == [cwd] * 4
+    assert os.getcwd() == cwd
+
+
+def test_pull_state_runs_in_directory(terraform, fake_terraform, stages):
+    fake_terraform('printf \'{"args": "%s", "cwd": "%s"}\' "$*" "$(pwd)"\n')
+
+    state = terraform.pull_state(str(stages.join('a')))
+
+    assert state == {'args': 'state pull', 'cwd': str(stages.join('a'))}
+
+
+def test_pull_state_skips_banner(terraform, fake_terraform, stages):
+    fake_terraform('echo "Terraform is out of date"\necho \'{"serial": 3}\'\n')
+
+    assert terraform.pull_state(str(stages)) == {'serial': 3}
+
+
+def test_pull_state_failure(terraform, fake_terraform, stages):
+    from ati.errors import StatePullError
+    fake_terraform('echo "backend not initialized" >&2\nexit 1\n')
+
+    with pytest.raises(StatePullError) as excinfo:
+        terraform.pull_state(str(stages))
+
+    assert 'backend not initialized' in str(excinfo.value)
+
+
+def test_pull_state_timeout(terraform, fake_terraform, stages):
+    from ati.errors import StatePullError
+    fake_terraform('exec sleep 10\n')
+
+    started = time.time()
+    with pytest.raises(StatePullError) as excinfo:
+        terraform.pull_state(str(stages), timeout=0.2)
+
+    assert 'timed out' in str(excinfo.value)
+    assert time.time() - started < 5
+
+
+def test_pull_state_workspace(terraform, fake_terraform, stages):
+    fake_terraform('printf \'{"workspace": "%s"}\' "$TF_WORKSPACE"\n')
+
+    state = terraform.pull_state(str(stages), workspace='dev')
+
+    assert state == {'workspace': 'dev'}
+
+
+def write_state(path, lineage, serial, resources=()):
+    path.write(json.dumps({
+        'version': 3, 'serial': serial, 'lineage': lineage,
+        'modules': [{'path': ['root'], 'resources': dict(
+            (key, {'type': key.split('.')[0]}) for key in resources)}]}),
+        ensure=True)
+    return str(path)
+
+
+def test_state_header(terraform, tmpdir):
+    path = write_state(tmpdir.join('terraform.tfstate'), 'abc', 7)
+    assert terraform.state_header(path) == {'serial': 7, 'lineage': 'abc'}
+    assert terraform.state_header({'serial': 3}) == {
+        'serial': 3, 'lineage': None}
+
+
+def test_unique_lineage_keeps_newest(terraform):
+    states = [{'lineage': 'a', 'serial': 1, 'n': 0},
+              {'lineage': 'b', 'serial': 1, 'n': 1},
+              {'lineage': 'a', 'serial': 2, 'n': 2},
+              {'n': 3}, {'n': 4}]
+
+    unique = list(terraform.unique_lineage(states))
+
+    assert [state['n'] for state in unique] == [1, 2, 3, 4]
+
+
+def test_iter_states_hybrid(terraform, tmpdir, monkeypatch):
+    pulled = []
+
+    def pull(dpath, **kwargs):
+        pulled.append(dpath)
+        return {'lineage': 'remote', 'serial': 4, 'modules': []}
+    monkeypatch.setattr(terraform, 'pull_state', pull)
+
+    # a directory with nothing but local states
+    plain = write_state(tmpdir.join('a', 'terraform.tfstate'), 'plain', 1)
+    # a local backend, read from disk
+    tmpdir.join('b', '.terraform').ensure(dir=True)
+    local = write_state(tmpdir.join('b', 'terraform.tfstate'), 'local', 1)
+    # a remote backend without a native reader, and a stale copy of it
+    tmpdir.join('c', '.terraform', 'terraform.tfstate').write(json.dumps(
+        {'backend': {'type': 'artifactory', 'config': {}}}), ensure=True)
+    write_state(tmpdir.join('d', 'terraform.tfstate'), 'remote', 3)
+
+    states = list(terraform.iter_states(str(tmpdir), hybrid=True))
+
+    assert states == [plain, local,
+                      {'lineage': 'remote', 'serial': 4, 'modules': []}]
+    assert pulled == [str(tmpdir.join('c'))]
@@ -0,0 +1,179 @@
+# -*- coding: utf-8 -*-
+import io
+import json
+
+import pytest
+
+
+@pytest.fixture
+def stream():
+    from ati import stream
+    return stream
+
+
+def loaded_resources(state):
+    return [(module['path'][-1], key, resource)
+            for module in state['modules']
+            for key, resource in module['resources'].items()]
+
+
+def streamed_resources(stream, data, chunk_size):
+    scanner = stream.Scanner(io.BytesIO(data), chunk_size=chunk_size)
+    return list(stream.iter_resources(scanner))
+
+
+@pytest.mark.parametrize('fixture', ['local_init.json', 'remote_state.json'])
+@pytest.mark.parametrize('chunk_size', [1, 7, 1024, 1 << 20])
+def test_iter_resources_matches_json_load(stream, fixture_path, fixture,
+                                          chunk_size):
+    with open(fixture_path(fixture), 'rb') as state_file:
+        data = state_file.read()
+
+    assert streamed_resources(stream, data, chunk_size) == \
+        loaded_resources(json.loads(data.decode('utf-8')))
+
+
+TRICKY = {
+    'version': 3,
+    'outputs': {'note': 'a "quoted" {brace} [bracket] \\ backslash'},
+    'modules': [{
+        'resources': {
+            'aws_instance.ü': {'primary': {'attributes': {
+                'tags.Name': 'snow ☃', 'escaped': '\\"}]',
+                'numbers': [1, -2.5e3, True, False, None]}}},
+        },
+        'path': ['root', 'late_path'],
+    }, {
+        'path': ['root'],
+        'resources': {},
+    }],
+}
+
+
+@pytest.mark.parametrize('chunk_size', [1, 2, 3, 5, 64])
+def test_iter_resources_tricky(stream, chunk_size):
+    data = json.dumps(TRICKY, indent=2, ensure_ascii=False).encode('utf-8')
+
+    assert streamed_resources(stream, data, chunk_size) == \
+        loaded_resources(TRICKY)
+
+
+def test_iter_resources_in_memory(stream):
+    data = json.dumps(TRICKY).encode('utf-8')
+
+    scanner = stream.Scanner(data=data)
+
+    assert list(stream.iter_resources(scanner)) == loaded_resources(TRICKY)
+
+
+def test_iter_resources_bounded_memory(stream):
+    resource = {'type': 'aws_security_group_rule', 'primary': {
+        'attributes': dict(('key{}'.format(i), 'x' * 50) for i in range(20))}}
+    state = {'version': 3, 'modules': [{'path': ['root'], 'resources': dict(
+        ('aws_security_group_rule.r{}'.format(i), resource)
+        for i in range(5000))}]}
+    data = json.dumps(state).encode('utf-8')
+    largest = len(json.dumps(resource))
+
+    scanner = stream.Scanner(io.BytesIO(data), chunk_size=4096)
+    biggest_buffer = 0
+    for count, _ in enumerate(stream.iter_resources(scanner), 1):
+        biggest_buffer = max(biggest_buffer, len(scanner.buf))
+
+    assert count == 5000
+    assert len(data) > 100 * (largest + 4096)
+    assert biggest_buffer < 4 * (largest + 4096)
+
+
+@pytest.mark.parametrize('data', [
+    b'', b'{"modules": [', b'{"modules": [{"path": ["root"]}',
+    b'{"modules" [] }', b'{"modules": [] ]'])
+def test_iter_resources_invalid(stream, data):
+    with pytest.raises(ValueError):
+        streamed_resources(stream, data, 4)
+
+
+def test_iterresources_streams_files(tmpdir):
+    from ati.terraform import iterresources
+    path = tmpdir.join('terraform.tfstate')
+    path.write(json.dumps(TRICKY))
+
+    assert list(iterresources([str(path)])) == loaded_resources(TRICKY)
+
+
+# `tru` and `NaNa` don't decode, but skipping over them works all the same
+UNWANTED = b'''{"version": 3, "modules": [{"path": ["root"], "resources": {
+    "aws_iam_policy.p": {"type": "aws_iam_policy", "primary": {"x": tru}},
+    "aws_instance.web": {"type": "aws_instance"},
+    "data.aws_ami.ubuntu": {"primary": {"x": NaNa}}}}]}'''
+
+
+@pytest.mark.parametrize('chunk_size', [3, 1024])
+def test_iter_resources_skips_unwanted(stream, chunk_size):
+    scanner = stream.Scanner(io.BytesIO(UNWANTED), chunk_size=chunk_size)
+
+    resources = list(stream.iter_resources(
+        scanner, lambda key: key.startswith('aws_instance.')))
+
+    assert resources == [('root', 'aws_instance.web', {'type': 'aws_instance'})]
+
+
+def test_iterresources_types(tmpdir):
+    from ati.terraform import PARSERS, iterresources
+    path = tmpdir.join('terraform.tfstate')
+    path.write(UNWANTED, mode='wb')
+    state = {'modules': [{'path': ['root'], 'resources': {
+        'aws_iam_policy.p': {}, 'aws_instance.db': {}}}]}
+
+    resources = list(iterresources([str(path), state], types=PARSERS))
+
+    assert [key for _, key, _ in resources] == [
+        'aws_instance.web', 'aws_instance.db']
+
+
+def test_skip_bounded_memory(stream):
+    data = json.dumps({'modules': [{'x': 'y' * 100}] * 5000,
+                       'serial': 3}).encode('utf-8')
+    scanner = stream.Scanner(io.BytesIO(data), chunk_size=4096)
+    biggest_buffer = 0
+    for _ in scanner.members():
+        scanner.skip()
+        biggest_buffer = max(biggest_buffer, len(scanner.buf))
+
+    assert len(data) > 100 * 4096
+    assert biggest_buffer < 4 * 4096
+
+
+@pytest.mark.parametrize('in_memory', [False, True])
+def test_file_header_past_the_head(stream, tmpdir, in_memory):
+    state = {'version': 3, 'modules': [
+        {'path': ['root'], 'resources': {'r{}'.format(i): {'x': 'y' * 100}
+                                         for i in range(100)}}],
+        'lineage': 'a-b', 'outputs': {'serial': 'not this one'}, 'serial': 4}
+    path = tmpdir.join('terraform.tfstate')
+    path.write(json.dumps(state))
+    data = path.read('rb') if in_memory else None
+
+    assert stream.file_header(str(path), data) == \
+        {'serial': 4, 'lineage': 'a-b'}
+
+
+@pytest.mark.parametrize('data, header', [
+    (b'[]', {'serial': None, 'lineage': None}),
+    (b'{"modules": []}', {'serial': None, 'lineage': None}),
+    (b'{"lineage": "a"}', {'serial': None, 'lineage': 'a'}),
+])
+def test_file_header_missing(stream, tmpdir, data, header):
+    path = tmpdir.join('terraform.tfstate')
+    path.write(data, mode='wb')
+
+    assert stream.file_header(str(path)) == header
+
+
+@pytest.mark.parametrize('data', [b'', b'{"modules": [', b'{"x" 1}'])
+def test_file_header_invalid(stream, tmpdir, data):
+    path = tmpdir.join('terraform.tfstate')
+    path.write(data, mode='wb')
+
+    with pytest.raises(ValueError):
+        stream.file_header(str(path))
@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+import io
+import json
+
+import pytest
+
+
+@pytest.fixture
+def state(fixture_path):
+    with open(fixture_path('v4_state.json')) as state_file:
+        return json.load(state_file)
+
+
+@pytest.fixture
+def data(fixture_path):
+    with open(fixture_path('v4_state.json'), 'rb') as state_file:
+        return state_file.read()
+
+
+def test_keys_and_modules(state):
+    from ati.stream import state_resources
+
+    assert [(name, key) for name, key, _ in state_resources(state)] == [
+        ('root', 'data.aws_ami.ubuntu'),
+        ('root', 'aws_instance.control.0'),
+        ('root', 'aws_instance.control.1'),
+        ('root', 'aws_security_group.control'),
+        ('workers', 'digitalocean_droplet.worker["a"]'),
+        ('workers', 'digitalocean_droplet.worker["b"]'),
+    ]
+
+
+@pytest.mark.parametrize('module,name', [
+    (None, 'root'), ('module.a', 'a'), ('module.a.module.b', 'b'),
+    ('module.a[0].module.b["x"]', 'b')])
+def test_module_name(module, name):
+    from ati.stream import module_name
+
+    assert module_name(module) == name
+
+
+@pytest.mark.parametrize('chunk_size', [5, 1 << 16])
+def test_streamed_like_loaded(state, data, chunk_size):
+    from ati.stream import Scanner, iter_resources, state_resources
+    scanner = Scanner(io.BytesIO(data), chunk_size=chunk_size)
+
+    streamed = list(iter_resources(scanner))
+    loaded = list(state_resources(state))
+
+    assert [(name, key) for name, key, _ in streamed] == \
+        [(name, key) for name, key, _ in loaded]
+    assert [dict(resource['primary']['attributes'].items())
+            for _, _, resource in streamed] == \
+        [dict(resource['primary']['attributes'].items())
+         for _, _, resource in loaded]
+
+
+def test_unwanted_blocks_skipped(data):
+    from ati.stream import Scanner, iter_resources
+    from ati.terraform import PARSERS, _of_types
+    offsets = []
+
+    resources = list(iter_resources(
+        Scanner(io.BytesIO(data)), lambda key: _of_types(PARSERS, key),
+        offsets))
+
+    assert [key for _, key, _ in resources] == [
+        'aws_instance.control.0', 'aws_instance.control.1',
+        'digitalocean_droplet.worker["a"]', 'digitalocean_droplet.worker["b"]']
+    assert [entry[4] for entry in offsets] == [
+        'aws_instance', 'aws_instance',
+        'digitalocean_droplet', 'digitalocean_droplet']
+
+
+def test_typed_attributes(state):
+    from ati.flatmap import TypedAttributes
+    attrs = TypedAttributes(
+        state['resources'][1]['instances'][0]['attributes'])
+
+    assert attrs['tags.Name'] == 'mi-control-01'
+    assert attrs['ebs_optimized'] == 'false'
+    assert attrs['cpu_core_count'] == '1'
+    assert attrs['ebs_block_device.#'] == '1'
+    assert attrs['ebs_block_device.0.iops'] == '300'
+    assert attrs['tags.%'] == '4'
+    assert 'tags.sshUser' in attrs
+    assert 'tags.sshPrivateIp' not in attrs
+    assert 'user_data' not in attrs
+    assert 'tags' not in attrs
+    assert attrs.get('user_data', '{}') == '{}'
+    assert TypedAttributes({'tags': {'a.b': 'c'}})['tags.a.b'] == 'c'
+
+
+@pytest.mark.parametrize('index', [0, 1])
+def test_aws_host_like_flatmap(state, args, index):
+    from ati.flatmap import FlatMap, TypedAttributes
+    from ati.terraform import aws_host
+    typed = TypedAttributes(
+        state['resources'][1]['instances'][index]['attributes'])
+    flat = FlatMap(typed.items())
+
+    assert aws_host({'primary': {'attributes': typed}}, 'root', args=args) == \
+        aws_host({'primary': {'attributes': flat}}, 'root', args=args)
+
+
+def test_iterhosts(state, args):
+    from ati.terraform import iterhosts, iterresources
+
+    hosts = list(iterhosts(iterresources([state]), args))
+
+    assert [name for name, _, _ in hosts] == [
+        'mi-control-01', 'mi-control-02', 'mi-worker-a', 'mi-worker-b']
+    _, attrs, groups = hosts[0]
+    assert attrs['ebs_block_device'] == [{
+        'delete_on_termination': 'false', 'device_name': 'xvdh',
+        'encrypted': 'false', 'iops': '300', 'snapshot_id': '',
+        'volume_size': '100', 'volume_type': 'gp2'}]
+    assert attrs['tags'] == {'Name': 'mi-control-01', 'dc': 'aws',
+                             'role': 'control', 'sshUser': 'ec2-user'}
+    assert attrs['ansible_ssh_user'] == 'ec2-user'
+    assert 'aws_vpc_security_group=sg-9d360cf9' in groups
+    _, attrs, groups = hosts[2]
+    assert attrs['private_ipv4'] == '10.132.0.2'
+    assert attrs['role'] == 'worker'
+    assert 'do_locked=False' in groups
+
+
+def test_offsets_index(tmpdir, cache, monkeypatch, data):
+    from ati import offsets
+    from ati.terraform import PARSERS, iterresources
+    monkeypatch.setattr(offsets, 'MIN_SIZE', 0)
+    path = tmpdir.join('terraform.tfstate')
+    path.write(data, mode='wb')
+
+    first = list(iterresources([str(path)], types=PARSERS))
+    monkeypatch.setattr(offsets, 'iter_resources', None)
+    second = list(iterresources([str(path)], types=PARSERS))
+
+    assert [(name, key, resource['primary']['attributes'].items())
+            for name, key, resource in second] == \
+        [(name, key, resource['primary']['attributes'].items())
+         for name, key, resource in first]
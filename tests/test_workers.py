@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+import json
+import pickle
+import sys
+
+import pytest
+
+
+@pytest.fixture
+def sources(sources):
+    """The state files, and one of them loaded."""
+    with open(sources[1]) as state_file:
+        state = json.load(state_file)
+    return sources + [state]
+
+
+def serial_hosts(sources, args):
+    from ati.terraform import PARSERS, iterhosts, iterresources
+    return list(iterhosts(iterresources(sources, types=PARSERS), args))
+
+
+def test_pool_hosts_like_serial(sources, args):
+    from ati.terraform import pool_hosts
+
+    hosts = list(pool_hosts(sources, args, 3))
+
+    assert len(hosts) == 10
+    assert json.dumps(hosts) == json.dumps(serial_hosts(sources, args))
+
+
+def test_pool_hosts_splits_large_states(sources, args, monkeypatch):
+    from ati import offsets, terraform
+    monkeypatch.setattr(offsets, 'MIN_SIZE', 0)
+    monkeypatch.setattr(terraform, 'CHUNK_RESOURCES', 1)
+    expected = serial_hosts(sources, args)  # builds the offset indexes
+
+    tasks = [task for source in sources
+             for task in terraform._host_tasks(source)]
+    hosts = list(terraform.pool_hosts(sources, args, 2))
+
+    assert [func.__name__ for func, _ in tasks].count('_chunk_hosts') == 6
+    assert json.dumps(hosts) == json.dumps(expected)
+
+
+def test_flatmap_pickles_attributes_only():
+    from ati.flatmap import FlatMap, TypedAttributes
+    flat = FlatMap({'tags.a': '1', 'tags.b': '2'})
+    flat.prefixed('tags')
+    typed = TypedAttributes({'tags': {'a': 1}, 'on': True})
+
+    assert pickle.loads(pickle.dumps(flat)).__dict__ == {
+        'plan': None, '_groups': {}}
+    assert pickle.loads(pickle.dumps(flat)) == flat
+    assert pickle.loads(pickle.dumps(typed)).items() == typed.items()
+
+
+def test_workers_arg(monkeypatch):
+    from ati import cli
+    monkeypatch.setattr(sys, 'argv', ['bin/ati', '--list', '--workers', '4'])
+    args, _ = cli.get_args()
+
+    assert args.workers == 4